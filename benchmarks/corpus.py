@@ -0,0 +1,190 @@
+"""Generate synthetic Python code to benchmark pyquotes.
+
+The generated code is deterministic (for a given seed), valid Python and
+uses a mix of quote styles, so it needs changes with either preferred quote
+style. The following kinds of corpora are available:
+
+- ``small-files``: many small modules in nested packages
+- ``huge-files``: a few modules of several MB each
+- ``fstrings``: code full of (nested) f-strings
+- ``docstrings``: code with lots of long docstrings
+- ``escapes``: strings with escaped quotes, backslashes and prefixes
+
+Usage: python benchmarks/corpus.py [--scale N] [--seed N] KIND DEST
+"""
+
+import argparse
+import random
+from pathlib import Path
+
+
+WORDS = (
+    'alpha beta gamma delta user name value item data config path file '
+    'request response error message status result token cache index key'
+).split()
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for __ in range(count))
+
+
+def _quote(rng, body):
+    # mostly double quotes, which are the ones changed by default
+    return f"'{body}'" if rng.random() < 0.35 else f'"{body}"'
+
+
+def _literal(rng):
+    return _quote(rng, _words(rng, rng.randint(1, 4)))
+
+
+def _docstring(rng, lines):
+    quote = "'''" if rng.random() < 0.3 else '"""'
+    body = '\n    '.join(
+        _words(rng, rng.randint(4, 10)).capitalize() for __ in range(lines)
+    )
+    return f'{quote}{body}\n    {quote}'
+
+
+def _typical_chunk(rng, i):
+    lit = lambda: _literal(rng)  # noqa: E731
+    return f'''
+
+def func_{i}(arg, other={lit()}):
+    {_docstring(rng, 1)}
+    value = {{{lit()}: arg, {lit()}: other, {lit()}: [{lit()}, {lit()}]}}
+    if arg == {lit()}:
+        raise ValueError({lit()})
+    logger.info({lit()}, arg)
+    return value.get({lit()}, {lit()})
+
+
+class Model{i}:
+    name = {lit()}
+    choices = ({lit()}, {lit()}, {lit()})
+
+    def describe(self):
+        return {lit()} % self.name
+'''
+
+
+def _fstring_chunk(rng, i):
+    word = lambda: rng.choice(WORDS)  # noqa: E731
+    # quotes inside the replacement fields must differ from the outer ones
+    outer, inner = rng.choice((('"', "'"), ("'", '"')))
+    return f'''
+
+def render_{i}(data, {word()}_{i}=None):
+    title = f{outer}{{data[{inner}{word()}{inner}]}} - {word()}{outer}
+    line = f"{{data['{word()}']!r:>10}} {word()} {{len(data)}}"
+    nested = f"{{', '.join(f'{{k}}={{v}}' for k, v in data.items())}}"
+    raw = rf"\\d+{{data.get('{word()}', 'x')}}"
+    multi = f"""
+    {{data['{word()}']}} {word()} "{word()}"
+    """
+    return f"{{title}}: {{line}} {{nested}} {{raw}} {{multi}}" + f'{{"{word()}"}}'
+'''
+
+
+def _docstring_chunk(rng, i):
+    return f'''
+
+class Documented{i}:
+    {_docstring(rng, rng.randint(5, 20))}
+
+    def method(self, {rng.choice(WORDS)}):
+        {_docstring(rng, rng.randint(3, 10)).replace(chr(10) + '    ', chr(10) + '        ')}
+        return {_literal(rng)}
+
+
+def helper_{i}():
+    """{_words(rng, 8)} "quoted" and 'quoted'."""
+    r"""{_words(rng, 5)} \\d+ raw."""
+'''
+
+
+def _escape_chunk(rng, i):
+    word = lambda: rng.choice(WORDS)  # noqa: E731
+    return f'''
+
+ESCAPES_{i} = [
+    "it's {word()}",
+    'say "{word()}"',
+    "say \\"{word()}\\" and 'it'",
+    'it\\'s \\"{word()}\\"',
+    "\\\\{word()}\\\\",
+    "\\\\"'"'"\\\\",
+    b"\\x00{word()}\\xff",
+    u"{word()} \\u00e9",
+    U"{word()}",
+    r"\\d+\\s*{word()}",
+    Rb"\\x{word()}",
+    "{word()}\\n\\t\\"{word()}\\"",
+    '{word()}\\\\\\'{word()}',
+]
+'''
+
+
+def _module(rng, chunk, size):
+    parts = ['import logging\n\n\nlogger = logging.getLogger(__name__)\n']
+    length = len(parts[0])
+    i = 0
+    while length < size:
+        part = chunk(rng, i)
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+# kind: (number of files, approximate size of each file, chunk generator)
+CORPORA = {
+    'small-files': (1000, 2_000, _typical_chunk),
+    'huge-files': (2, 2_000_000, _typical_chunk),
+    'fstrings': (100, 20_000, _fstring_chunk),
+    'docstrings': (100, 20_000, _docstring_chunk),
+    'escapes': (100, 20_000, _escape_chunk),
+}
+
+
+def generate_corpus(kind, dest, scale=1.0, seed=0):
+    """Generate a corpus of the given kind inside `dest`.
+
+    `scale` multiplies the number of files, or the size of the files if
+    there are only a few of them. Returns the paths of the generated files.
+    """
+    num_files, size, chunk = CORPORA[kind]
+    if num_files < 10:
+        size = int(size * scale)
+    else:
+        num_files = max(1, int(num_files * scale))
+    rng = random.Random(f'{kind}:{seed}')
+    dest = Path(dest)
+    paths = []
+    for i in range(num_files):
+        # a bit of nesting so walking the tree is not trivial
+        path = dest / f'pkg{i % 7}' / f'sub{i % 5}' / f'module{i}.py'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(_module(rng, chunk, size), encoding='utf-8')
+        paths.append(path)
+    # some excluded directories which should be skipped quickly
+    for name in ('build', '.tox', 'node_modules'):
+        path = dest / name / 'ignored.py'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('x = "y"\n', encoding='utf-8')
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('kind', choices=sorted(CORPORA))
+    parser.add_argument('dest', type=Path)
+    args = parser.parse_args()
+    paths = generate_corpus(args.kind, args.dest, args.scale, args.seed)
+    size = sum(path.stat().st_size for path in paths)
+    print(f'{len(paths)} files, {size / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
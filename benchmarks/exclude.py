@@ -0,0 +1,84 @@
+"""Benchmark checking paths against the exclude patterns.
+
+This compares `Config.is_path_excluded` with the previous implementation,
+which called `fnmatch` for each pattern, on a synthetic tree of 100k paths
+(nothing is created on disk since matching only looks at the path).
+
+Usage: python benchmarks/exclude.py [--paths N]
+"""
+
+import argparse
+import os
+import sys
+import time
+from fnmatch import fnmatch
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pyquotes.settings import Config  # noqa: E402
+
+
+EXTEND_EXCLUDE = ('tests/data', 'docs/_static', '*.generated.py', 'migrations')
+
+
+def _make_paths(root: Path, count: int):
+    # a tree with a bit of depth: pkgN/subN/moduleN.py plus some excluded dirs
+    names = ('build', 'node_modules', '.tox', 'migrations', 'tests', 'src')
+    paths = []
+    i = 0
+    while len(paths) < count:
+        top = root / f'pkg{i % 97}'
+        sub = top / names[i % len(names)] / f'sub{i % 13}'
+        paths.append(sub / f'module{i}.py')
+        paths.append(top / 'tests' / 'data' / f'case{i}.py')
+        paths.append(sub / f'model{i}.generated.py')
+        i += 1
+    return paths[:count]
+
+
+def _is_path_excluded_fnmatch(config: Config, path: Path):
+    patterns = config.excludes
+    basename = path.name
+    if basename not in ('.', '..') and any(fnmatch(basename, p) for p in patterns):
+        return True
+    absolute_path = path.absolute()
+    try:
+        relative_path = absolute_path.relative_to(config.project_root)
+    except ValueError:
+        pass
+    else:
+        if any(fnmatch(relative_path, p) for p in patterns):
+            return True
+    return any(fnmatch(absolute_path, p) for p in patterns)
+
+
+def _bench(func, paths):
+    start = time.perf_counter()
+    excluded = sum(1 for path in paths if func(path))
+    return time.perf_counter() - start, excluded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=int, default=100_000)
+    args = parser.parse_args()
+
+    root = Path(os.getcwd())
+    config = Config({'extend_exclude': EXTEND_EXCLUDE}, root)
+    paths = _make_paths(root, args.paths)
+    print(f'{len(paths)} paths, {len(config.excludes)} patterns')
+
+    old_time, old_excluded = _bench(
+        lambda p: _is_path_excluded_fnmatch(config, p), paths
+    )
+    new_time, new_excluded = _bench(config.is_path_excluded, paths)
+    assert old_excluded == new_excluded, (old_excluded, new_excluded)
+    print(f'fnmatch:  {old_time:.3f}s ({old_excluded} excluded)')
+    print(f'compiled: {new_time:.3f}s ({new_excluded} excluded)')
+    print(f'speedup:  {old_time / new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Benchmark the peak memory usage of processing huge files.
+
+For each size this generates a single module like those of the
+``huge-files`` corpus and processes it in a fresh interpreter, once with
+streaming (``--stream-threshold 1``) and once loading the whole file
+(``--stream-threshold 100G``), and reports the peak RSS of that process.
+The peak RSS of processing an empty file is reported as the baseline.
+
+Unix only, since it relies on `resource.getrusage`.
+
+Usage: python benchmarks/memory.py [--engine ENGINE] [--json PATH]
+           [--size MB ...]
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from corpus import _module, _typical_chunk  # noqa: E402
+
+import pyquotes  # noqa: E402
+from pyquotes.transform import ENGINES  # noqa: E402
+
+
+ROOT = Path(__file__).resolve().parent.parent
+MODES = {'stream': '1', 'full': '100G'}
+DEFAULT_SIZES = (1, 4, 16, 64)
+
+# runs pyquotes on a file and prints the peak RSS in KiB
+_CHILD = '''
+import resource
+import sys
+
+sys.path.insert(0, {root!r})
+
+from pyquotes.cli import main
+
+try:
+    main({args!r}, prog_name='pyquotes')
+except SystemExit:
+    pass
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def _generate(path, size):
+    # written in pieces so the benchmark itself does not need much memory
+    rng = random.Random('memory')
+    with path.open('w', encoding='utf-8') as f:
+        written = 0
+        while written < size:
+            code = _module(rng, _typical_chunk, 1_000_000)
+            f.write(code)
+            written += len(code)
+
+
+def _peak_rss(path, threshold, engine):
+    args = [
+        '--jobs=1',
+        '--no-cache',
+        '--quiet',
+        f'--engine={engine}',
+        '--stream-threshold',
+        threshold,
+        str(path),
+    ]
+    code = _CHILD.format(root=str(ROOT), args=args)
+    output = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE, check=True
+    ).stdout
+    return int(output.split()[-1]) * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=ENGINES, default='tree')
+    parser.add_argument('--json', type=Path, metavar='PATH')
+    parser.add_argument('--size', type=float, action='append', dest='sizes')
+    args = parser.parse_args()
+
+    results = {
+        'pyquotes': pyquotes.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': args.engine,
+        'sizes': [],
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'module.py'
+        path.touch()
+        results['baseline'] = _peak_rss(path, '1', args.engine)
+        print(f'baseline: {results["baseline"] / 1e6:.1f} MB')
+        for size in args.sizes or DEFAULT_SIZES:
+            result = {}
+            for mode, threshold in MODES.items():
+                # the file is updated in place, so start over each time
+                _generate(path, int(size * 1e6))
+                result['bytes'] = path.stat().st_size
+                result[mode] = _peak_rss(path, threshold, args.engine)
+            results['sizes'].append(result)
+            print(
+                f'{result["bytes"] / 1e6:8.1f} MB file: '
+                + ', '.join(f'{mode} {result[mode] / 1e6:8.1f} MB' for mode in MODES)
+            )
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
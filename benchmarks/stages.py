@@ -0,0 +1,210 @@
+"""Benchmark the stages of processing files on synthetic corpora.
+
+For each corpus generated by `corpus.py` this measures the throughput
+(files/s and MB/s) of the following stages separately:
+
+- ``expand``: walking the directory tree and applying the excludes
+- ``read``: reading and decoding the files
+- ``parse``: building the syntax tree or tokenizing, depending on the engine
+- ``normalize``: normalizing the quotes of all string literals
+- ``serialize``: applying the edits and encoding the result
+- ``write``: atomically writing the files
+- ``total``: processing the files like the CLI does (without workers)
+
+Each stage is run `--repeat` times and the fastest run is reported. Use
+`--json` to write the results to a file for comparing different versions
+or engines.
+
+Usage: python benchmarks/stages.py [--engine ENGINE] [--double-quotes]
+           [--scale N] [--repeat N] [--json PATH] [--corpus KIND ...]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import parso  # noqa: E402
+from corpus import CORPORA, generate_corpus  # noqa: E402
+from parso.utils import split_lines  # noqa: E402
+
+import pyquotes  # noqa: E402
+from pyquotes.cli import _atomic_overwrite, _expand_dirs, _process_file  # noqa: E402
+from pyquotes.encoding import decode_source  # noqa: E402
+from pyquotes.settings import Config  # noqa: E402
+from pyquotes.transform import (  # noqa: E402
+    ENGINES,
+    Edit,
+    _iter_string_tokens,
+    _iter_strings,
+    _normalize_string,
+    apply_edits,
+)
+
+
+STAGES = ('expand', 'read', 'parse', 'normalize', 'serialize', 'write', 'total')
+
+
+def _best_time(func, repeat):
+    best = None
+    for __ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # avoid dividing by zero for stages that are too fast to measure
+    return max(best, 1e-9)
+
+
+def _find_strings(source, engine):
+    # (is_doc, start, end) of all string literals
+    if engine == 'tokens':
+        return [
+            (is_doc, start, end)
+            for is_doc, __, start, end in _iter_string_tokens(source)
+        ]
+    tree = parso.parse(source)
+    line_offsets = [0]
+    for line in split_lines(source, keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+    strings = []
+    for is_doc, leaf in _iter_strings(tree):
+        line, column = leaf.start_pos
+        start = line_offsets[line - 1] + column
+        strings.append((is_doc, start, start + len(leaf.value)))
+    return strings
+
+
+def _bench_corpus(kind, args, root):
+    paths = generate_corpus(kind, root, args.scale)
+    config = Config({'double_quotes': args.double_quotes, 'engine': args.engine}, root)
+    num_bytes = sum(path.stat().st_size for path in paths)
+    times = {}
+
+    times['expand'] = _best_time(
+        lambda: list(_expand_dirs([root], config, lambda path: None)), args.repeat
+    )
+
+    sources = {}
+
+    def _read():
+        for path in paths:
+            sources[path] = decode_source(path.read_bytes())
+
+    times['read'] = _best_time(_read, args.repeat)
+
+    strings = {}
+
+    def _parse():
+        for path, (source, __) in sources.items():
+            strings[path] = _find_strings(source, args.engine)
+
+    times['parse'] = _best_time(_parse, args.repeat)
+
+    edits = {}
+    # bypass the memoization, otherwise all but the first run only measure
+    # looking up the results
+    normalize_string = _normalize_string.__wrapped__
+
+    def _normalize():
+        for path, (source, __) in sources.items():
+            edits[path] = file_edits = []
+            for is_doc, start, end in strings[path]:
+                value = source[start:end]
+                new_value = normalize_string(value, is_doc, args.double_quotes)
+                if new_value != value:
+                    file_edits.append(Edit(start, end, value, new_value, 0, 0))
+
+    times['normalize'] = _best_time(_normalize, args.repeat)
+
+    output = {}
+
+    def _serialize():
+        for path, (source, encoding) in sources.items():
+            output[path] = apply_edits(source, edits[path]).encode(encoding)
+
+    times['serialize'] = _best_time(_serialize, args.repeat)
+
+    def _write():
+        for path, data in output.items():
+            _atomic_overwrite(path, data)
+
+    times['write'] = _best_time(_write, args.repeat)
+
+    def _total():
+        # start from the original files each time
+        for path, (source, encoding) in sources.items():
+            path.write_bytes(source.encode(encoding))
+        _normalize_string.cache_clear()
+        start = time.perf_counter()
+        for path in paths:
+            _process_file(path, config)
+        return time.perf_counter() - start
+
+    times['total'] = max(min(_total() for __ in range(args.repeat)), 1e-9)
+
+    return {
+        'files': len(paths),
+        'bytes': num_bytes,
+        'changed_files': sum(1 for file_edits in edits.values() if file_edits),
+        'edits': sum(len(file_edits) for file_edits in edits.values()),
+        'stages': {
+            stage: {
+                'seconds': round(times[stage], 6),
+                'files_per_sec': round(len(paths) / times[stage], 1),
+                'mb_per_sec': round(num_bytes / 1e6 / times[stage], 3),
+            }
+            for stage in STAGES
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=ENGINES, default='tree')
+    parser.add_argument('--double-quotes', action='store_true')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', type=Path, metavar='PATH')
+    parser.add_argument(
+        '--corpus', action='append', dest='corpora', choices=sorted(CORPORA)
+    )
+    args = parser.parse_args()
+
+    results = {
+        'pyquotes': pyquotes.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': args.engine,
+        'double_quotes': args.double_quotes,
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'corpora': {},
+    }
+    for kind in args.corpora or CORPORA:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result = _bench_corpus(kind, args, Path(tmpdir).resolve())
+        results['corpora'][kind] = result
+        print(
+            f'{kind}: {result["files"]} files, {result["bytes"] / 1e6:.1f} MB, '
+            f'{result["edits"]} edits'
+        )
+        for stage, data in result['stages'].items():
+            print(
+                f'  {stage:<10} {data["seconds"]:8.3f}s '
+                f'{data["files_per_sec"]:10.1f} files/s '
+                f'{data["mb_per_sec"]:8.2f} MB/s'
+            )
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2) + '\n')
+
+
+if __name__ == '__main__':
+    main()
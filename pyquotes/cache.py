@@ -0,0 +1,111 @@
+import json
+import os
+import typing as t
+from pathlib import Path
+
+import pyquotes
+
+
+CACHE_DIR_NAME = '.pyquotes_cache'
+
+# (mtime, size) of a file that is known to be normalized
+FileStat = t.Tuple[float, int]
+
+
+def get_cache_dir(project_root: Path) -> Path:
+    return Path(project_root) / CACHE_DIR_NAME
+
+
+def get_file_stat(path: Path) -> FileStat:
+    stat = path.stat()
+    return stat.st_mtime, stat.st_size
+
+
+def clear_cache(project_root: Path):
+    import shutil
+
+    shutil.rmtree(get_cache_dir(project_root), ignore_errors=True)
+
+
+def clear_caches(project_root: Path):
+    """Delete the cache of the project and those of all projects inside it.
+
+    Each directory with its own config file has its own cache, so e.g. the
+    subprojects of a monorepo need to be found by walking the project.
+    """
+    for directory, dirnames, __ in os.walk(project_root):
+        if CACHE_DIR_NAME in dirnames:
+            clear_cache(Path(directory))
+            dirnames.remove(CACHE_DIR_NAME)
+
+
+class Cache:
+    """Keep track of files that are known to be normalized.
+
+    There is one cache file per pyquotes version and quote style, so
+    upgrading pyquotes or switching the preferred quotes never uses
+    stale data.
+    """
+
+    def __init__(self, path: Path, entries: t.Dict[str, FileStat]):
+        self.path = path
+        self._entries = entries
+        self._new_entries: t.Dict[str, FileStat] = {}
+
+    @classmethod
+    def load(cls, project_root: Path, double_quotes: bool) -> 'Cache':
+        quotes = 'double' if double_quotes else 'single'
+        name = f'cache.{pyquotes.__version__}.{quotes}.json'
+        path = get_cache_dir(project_root) / name
+        return cls(path, _read_entries(path))
+
+    def is_clean(self, file: Path) -> bool:
+        key = str(file.absolute())
+        entry = self._new_entries.get(key) or self._entries.get(key)
+        if entry is None:
+            return False
+        try:
+            return get_file_stat(file) == entry
+        except OSError:
+            return False
+
+    def mark_clean(self, file: Path, stat: FileStat):
+        self._new_entries[str(file.absolute())] = stat
+
+    def write(self):
+        if not self._new_entries:
+            return
+        # merge with whatever is on disk right now so we do not discard entries
+        # written by another run since we loaded the cache; the atomic replace
+        # ensures concurrent runs never see a partially written file
+        entries = {**_read_entries(self.path), **self._new_entries}
+        import tempfile
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=f'{self.path.name}.', dir=self.path.parent
+            )
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # not being able to write the cache should never break anything
+            return
+        self._entries = entries
+        self._new_entries = {}
+
+
+def _read_entries(path: Path) -> t.Dict[str, FileStat]:
+    try:
+        with path.open(encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {k: tuple(v) for k, v in data.items()}
@@ -1,15 +1,100 @@
-import difflib
+import collections
+import functools
+import mmap
+import os
 import pathlib
-import shutil
 import sys
+import time
 import typing as t
-from datetime import datetime
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, replace
+from stat import S_IMODE, S_ISDIR, S_ISREG
 
 import click
 
 import pyquotes
-from pyquotes.settings import Config
-from pyquotes.transform import transform_source
+from pyquotes import timings
+from pyquotes.cache import Cache, FileStat, clear_caches, get_file_stat
+from pyquotes.diff import format_patch, unified_diff
+from pyquotes.encoding import decode_source, get_encoding
+from pyquotes.quotes import may_change
+from pyquotes.settings import Config, _find_config
+from pyquotes.transform import (
+    ENGINES,
+    Edit,
+    LineRanges,
+    _InvalidSource,
+    _iter_transformed_parts,
+    _tokens_need_changes,
+    apply_edits,
+    iter_edits,
+    needs_changes,
+)
+
+
+OUTPUT_FORMATS = ('text', 'ndjson')
+DURABILITY_MODES = ('none', 'file', 'batch')
+
+# files larger than this are memory-mapped instead of read when checking
+# whether they may need changes
+MMAP_THRESHOLD = 1024 * 1024
+
+# number of files submitted to each worker process ahead of the one whose
+# result we are waiting for
+POOL_WINDOW_PER_JOB = 2
+
+# number of threads reading and writing files when using --pipeline
+PIPELINE_IO_THREADS = 16
+# maximum number of files in the pipeline at once, which limits the memory
+# used for files read ahead of processing them
+PIPELINE_WINDOW = 64
+
+# amount of data read or written at once when processing big files piece by
+# piece, which is much more than the first two lines needed to detect the
+# encoding
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# how often we try to find an unused name for a temporary file
+TEMP_FILE_ATTEMPTS = 100
+
+
+def _clear_cache(ctx: click.Context, param: click.Parameter, value: bool):
+    if not value or ctx.resilient_parsing:
+        return
+    project_root, __ = _find_config(pathlib.Path.cwd())
+    clear_caches(project_root)
+    ctx.exit()
+
+
+def _parse_line_ranges(
+    ctx: click.Context, param: click.Parameter, value: t.Optional[str]
+) -> t.Optional[t.Tuple[t.Tuple[int, int], ...]]:
+    if value is None:
+        return None
+    line_ranges = []
+    for item in value.split(','):
+        first, sep, last = item.strip().partition('-')
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            raise click.BadParameter(f'invalid line range: {item}')
+        if first < 1 or last < first:
+            raise click.BadParameter(f'invalid line range: {item}')
+        line_ranges.append((first, last))
+    return tuple(line_ranges)
+
+
+def _parse_size(
+    ctx: click.Context, param: click.Parameter, value: t.Optional[str]
+) -> t.Optional[int]:
+    if value is None:
+        return None
+    number = value.upper().rstrip('KMG')
+    unit = value[len(number) :].upper()
+    if not number.isdigit() or len(unit) > 1 or not int(number):
+        raise click.BadParameter(f'invalid size: {value}')
+    return int(number) * 1024 ** ' KMG'.index(unit or ' ')
 
 
 @click.command()
@@ -31,6 +116,22 @@ from pyquotes.transform import transform_source
 @click.option(
     '--diff', '-d', is_flag=True, help='Only show diffs without updating files.'
 )
+@click.option(
+    '--patch',
+    is_flag=True,
+    help='''
+    Only output a patch for all files (to be applied using "git apply") without
+    updating them.
+    ''',
+)
+@click.option(
+    '--format',
+    type=click.Choice(OUTPUT_FORMATS),
+    help='''
+    How to report the results: "text" for humans, or "ndjson" to write one JSON
+    object per file and a final summary to stdout. Defaults to "text".
+    ''',
+)
 @click.option(
     '--check-only',
     '--check',
@@ -38,6 +139,14 @@ from pyquotes.transform import transform_source
     is_flag=True,
     help='Only check files without updating them.',
 )
+@click.option(
+    '--fail-fast',
+    is_flag=True,
+    help=(
+        'Stop at the first file that needs changes or could not be processed. '
+        'Only allowed with --check-only, --diff or --patch.'
+    ),
+)
 @click.option(
     '--exclude',
     multiple=True,
@@ -57,6 +166,124 @@ from pyquotes.transform import transform_source
     Extends the built-in excludes. Does not apply to explicitly-specified files.
     ''',
 )
+@click.option(
+    '--jobs',
+    '-j',
+    type=click.IntRange(min=1),
+    help='Number of files to process in parallel. Defaults to the number of CPUs.',
+)
+@click.option(
+    '--pipeline',
+    is_flag=True,
+    help='''
+    Read and write files concurrently while processing them. Useful on slow
+    (e.g. network) filesystems.
+    ''',
+)
+@click.option(
+    '--stream-threshold',
+    metavar='SIZE',
+    callback=_parse_size,
+    help='''
+    Process files larger than this (e.g. "512K" or "100M") piece by piece,
+    which keeps the memory usage low. Does not apply to --diff and --patch.
+    Defaults to 16M.
+    ''',
+)
+@click.option(
+    '--durability',
+    type=click.Choice(DURABILITY_MODES),
+    help='''
+    How updated files are synced to disk: "none" leaves it to the operating
+    system, "file" syncs each file as soon as it is written, and "batch" syncs
+    all of them at the end. Defaults to "none".
+    ''',
+)
+@click.option(
+    '--preserve-mtime',
+    is_flag=True,
+    help='''
+    Keep the modification time of updated files, so e.g. build systems do not
+    consider them changed.
+    ''',
+)
+@click.option(
+    '--engine',
+    type=click.Choice(ENGINES),
+    help='''
+    How strings are located: "tree" builds a full syntax tree, "tokens" only
+    tokenizes the code which is faster. Defaults to "tree".
+    ''',
+)
+@click.option(
+    '--changed-since',
+    metavar='REF',
+    help='''
+    Only process files that were added or modified since the specified git ref,
+    including uncommitted and untracked files.
+    ''',
+)
+@click.option(
+    '--changed-lines',
+    is_flag=True,
+    help='''
+    Together with --changed-since, only normalize strings on lines that were
+    added or modified since the specified git ref.
+    ''',
+)
+@click.option(
+    '--line-ranges',
+    metavar='RANGES',
+    callback=_parse_line_ranges,
+    help='''
+    Only normalize strings starting on the specified lines, e.g. "10-20,55".
+    ''',
+)
+@click.option(
+    '--no-cache',
+    is_flag=True,
+    help='Do not skip files that were already up to date in a previous run.',
+)
+@click.option(
+    '--clear-cache',
+    is_flag=True,
+    is_eager=True,
+    expose_value=False,
+    callback=_clear_cache,
+    help='''
+    Delete the cache of up-to-date files of the current project and those of
+    all projects inside it, and exit.
+    ''',
+)
+@click.option(
+    '--timings',
+    is_flag=True,
+    help='''
+    Show how much time was spent in the different stages of processing the
+    files, and which files were the slowest to process.
+    ''',
+)
+@click.option(
+    '--timings-json',
+    metavar='PATH',
+    help='Write the timings of all files to a JSON file. Implies --timings.',
+)
+@click.option(
+    '--profile',
+    metavar='PATH',
+    help='''
+    Profile the run using cProfile and write the stats to the specified file.
+    Use --jobs=1 to include the processing of the files.
+    ''',
+)
+@click.option(
+    '--stdin-filename',
+    metavar='PATH',
+    help='''
+    The name of the file passed via stdin. Used to find the config file and to
+    check whether the file is excluded.
+    ''',
+)
 @click.argument(
     'files',
     nargs=-1,
@@ -66,6 +293,7 @@ from pyquotes.transform import transform_source
         file_okay=True,
         dir_okay=True,
         readable=True,
+        allow_dash=True,
     ),
 )
 def main(files: t.List[pathlib.Path], **cli_settings):
@@ -73,83 +301,1040 @@ def main(files: t.List[pathlib.Path], **cli_settings):
     A tool that ensures consistent string quotes in your Python code.
 
     When passing a directory, all *.py files inside will be processed recursively.
+    When passing "-", the code is read from stdin and the updated code is written
+    to stdout.
 
     If any files needed changes, it exits with a non-zero status code.
     """
     # discard all missing values to get the dataclass defaults
     cli_settings = {k: v for k, v in cli_settings.items() if v}
+    stdin_filename = cli_settings.get('stdin_filename')
+    config_path = pathlib.Path(stdin_filename).parent if stdin_filename else None
     try:
-        config = Config(cli_settings)
+        config = Config(cli_settings, config_path)
     except ValueError as exc:
         raise click.BadArgumentUsage(str(exc))
+    if '-' in files:
+        if len(files) > 1:
+            raise click.BadArgumentUsage('"-" cannot be combined with other files')
+        if config.format == 'ndjson':
+            raise click.BadArgumentUsage('ndjson format cannot be used with "-"')
+    elif stdin_filename:
+        raise click.BadArgumentUsage('stdin-filename requires "-" as the file')
+    if config.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            has_changes = profiler.runcall(_run, files, config)
+        finally:
+            profiler.dump_stats(config.profile)
+    else:
+        has_changes = _run(files, config)
+    sys.exit(1 if has_changes else 0)
+
+
+def _run(files: t.List[str], config: Config) -> bool:
+    if '-' in files:
+        return _process_stdin(config)
+    start_time = time.perf_counter()
+    ndjson = config.format == 'ndjson'
     has_changes = False
+    quick_rejected = 0
+    counts = dict.fromkeys(('changed', 'unchanged', 'excluded', 'error'), 0)
+
+    def _excluded(path: pathlib.Path):
+        counts['excluded'] += 1
+        if ndjson:
+            _echo_record(type='file', path=str(path), status='excluded')
+        elif config.verbose:
+            click.echo(f'{path} is excluded', err=True)
+
     files = [pathlib.Path(f) for f in files]  # `path_type` in click 7 is useless
-    for file in _expand_dirs(files, config):
+    file_line_ranges = None
+    if config.timings:
+        timings.start()
+    with timings.measure('walk'):
+        if config.changed_since:
+            from pyquotes.git import GitError, get_changed_files, get_changed_lines
+
+            cwd = pathlib.Path.cwd()
+            try:
+                if config.changed_lines:
+                    changed_lines = get_changed_lines(config.changed_since, cwd)
+                    changed = set(changed_lines)
+                else:
+                    changed = get_changed_files(config.changed_since, cwd)
+            except GitError as exc:
+                raise click.ClickException(f'Could not get changed files: {exc}')
+            files = list(_expand_changed(files, config, changed, _excluded))
+            if config.changed_lines:
+                file_line_ranges = {
+                    file: changed_lines[file.resolve()] for file in files
+                }
+        else:
+            files = _expand_dirs(files, config, _excluded)
+            # the pipeline processes files while the directories are walked
+            if not config.pipeline:
+                files = list(files)
+    global_timings = timings.stop()
+    file_timings = {}
+    # files may belong to different projects, each having its own cache
+    caches: t.Dict[t.Tuple[pathlib.Path, bool], Cache] = {}
+
+    def _get_cache(file_config: Config) -> t.Optional[Cache]:
+        if config.no_cache:
+            return None
+        key = (file_config.project_root, file_config.double_quotes)
+        if key not in caches:
+            caches[key] = Cache.load(*key)
+        return caches[key]
+
+    # files updated by us which still need to be synced to disk
+    updated = []
+    writes = not config.check_only and not config.diff and not config.patch
+    # the first error when not using ndjson, which is raised once the files
+    # already updated by workers have been reported
+    first_error = None
+    results = _iter_results(
+        files, config, _get_cache, file_line_ranges, lambda: first_error is not None
+    )
+    try:
+        for file, get_result in results:
+            try:
+                result = get_result()
+            except Exception as exc:
+                if not ndjson:
+                    click.echo(f'Error while processing {file}', err=True)
+                    if not writes:
+                        raise
+                    if first_error is None:
+                        first_error = exc
+                    continue
+                # keep going so the output covers all files
+                counts['error'] += 1
+                error = f'{type(exc).__name__}: {exc}'
+                _echo_record(type='file', path=str(file), status='error', error=error)
+                if config.fail_fast:
+                    break
+                continue
+            status = 'changed' if result.changed else 'unchanged'
+            counts[status] += 1
+            if ndjson:
+                _echo_record(
+                    type='file',
+                    path=str(file),
+                    status=status,
+                    changes=result.changes,
+                    duration=round(result.duration, 6),
+                )
+            else:
+                for message, err in result.messages:
+                    click.echo(message, err=err)
+            if result.changed:
+                has_changes = True
+                if writes and config.durability == 'batch':
+                    updated.append(file)
+            if result.quick_rejected:
+                quick_rejected += 1
+            if result.timings is not None:
+                file_timings[str(file)] = result.timings
+            if result.clean_stat is not None:
+                cache = _get_cache(config.for_directory(file.parent))
+                if cache is not None:
+                    cache.mark_clean(file, result.clean_stat)
+            if result.changed and config.fail_fast:
+                break
+    finally:
+        # stops processing the remaining files when failing fast
+        results.close()
+        if updated:
+            _sync_files(updated)
+        for cache in caches.values():
+            cache.write()
+    if first_error is not None:
+        raise first_error
+    if config.verbose and quick_rejected:
+        click.echo(f'{quick_rejected} file(s) did not need to be parsed', err=True)
+    if config.timings:
+        _report_timings(config, global_timings, file_timings)
+    if ndjson:
+        duration = round(time.perf_counter() - start_time, 6)
+        num_files = counts['changed'] + counts['unchanged'] + counts['error']
+        _echo_record(type='summary', files=num_files, **counts, duration=duration)
+    return has_changes or bool(counts['error'])
+
+
+def _echo_record(**record):
+    import json
+
+    click.echo(json.dumps(record))
+
+
+@dataclass(frozen=True)
+class _FileResult:
+    changed: bool
+    # (message, err) tuples which are echoed by the main process so the output
+    # stays in the order the files were specified even when using workers
+    messages: t.Tuple[t.Tuple[t.Union[str, bytes], bool], ...] = ()
+    # set if the file is up to date after processing it
+    clean_stat: t.Optional[FileStat] = None
+    # set if a quick scan showed that the file cannot need any changes
+    quick_rejected: bool = False
+    # number of changed string literals; None if unknown since we stopped at
+    # the first one
+    changes: t.Optional[int] = 0
+    # time it took to process the file
+    duration: float = 0
+    # time spent in each stage when using --timings
+    timings: t.Optional[t.Dict[str, float]] = None
+
+
+def _iter_results(
+    files: t.List[pathlib.Path],
+    config: Config,
+    get_cache: t.Callable[[Config], t.Optional[Cache]],
+    file_line_ranges: t.Optional[t.Dict[pathlib.Path, LineRanges]] = None,
+    stopped: t.Callable[[], bool] = lambda: False,
+) -> t.Iterable[t.Tuple[pathlib.Path, t.Callable[[], _FileResult]]]:
+    # once `stopped` returns true, no more files are processed, but the files
+    # which were already being processed (and maybe updated) are still yielded
+    def _get_line_ranges(file):
+        if file_line_ranges is None:
+            return config.line_ranges
+        return file_line_ranges[file]
+
+    if config.pipeline:
+        yield from _iter_pipeline_results(
+            files, config, get_cache, _get_line_ranges, stopped
+        )
+        return
+
+    file_configs = {file: config.for_directory(file.parent) for file in files}
+    cached = set()
+    for file, file_config in file_configs.items():
+        cache = get_cache(file_config)
+        if cache is not None and cache.is_clean(file):
+            cached.add(file)
+    pending = [file for file in files if file not in cached]
+
+    if config.jobs == 1 or len(pending) < 2:
+        for file in files:
+            if stopped():
+                return
+            file_config = file_configs[file]
+            if file in cached:
+                yield file, functools.partial(_up_to_date, file, file_config)
+            else:
+                line_ranges = _get_line_ranges(file)
+                yield file, functools.partial(
+                    _process_file, file, file_config, line_ranges
+                )
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # workers read and write the files themselves and only send back a small
+    # result object, so we never have to pickle the source code of a file.
+    # only a few files are submitted ahead of the one whose result we wait for,
+    # so when stopping early there are only a few more that may be updated
+    jobs = min(config.jobs, len(pending))
+    max_window = jobs * POOL_WINDOW_PER_JOB
+    # (file, future) pairs in order, the future being None for cached files
+    window = collections.deque()
+
+    def _pop():
+        file, future = window.popleft()
+        if future is None:
+            return file, functools.partial(_up_to_date, file, file_configs[file])
+        return file, future.result
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
         try:
-            changed = _process_file(file, config=config)
-        except Exception:
-            click.echo(f'Error while processing {file}', err=True)
-            raise
-        if changed:
-            has_changes = True
-    sys.exit(1 if has_changes else 0)
+            for file in files:
+                if file in cached:
+                    window.append((file, None))
+                else:
+                    future = executor.submit(
+                        _process_file, file, file_configs[file], _get_line_ranges(file)
+                    )
+                    window.append((file, future))
+                while window and not stopped():
+                    if window[0][1] is not None and len(window) <= max_window:
+                        break
+                    yield _pop()
+                if stopped():
+                    break
+            while window and not stopped():
+                yield _pop()
+            for file, future in window:
+                # files which are already being processed when stopping early
+                if future is not None and not future.cancel():
+                    yield file, future.result
+        finally:
+            for __, future in window:
+                if future is not None:
+                    future.cancel()
+
+
+def _iter_pipeline_results(
+    files: t.Iterable[pathlib.Path],
+    config: Config,
+    get_cache: t.Callable[[Config], t.Optional[Cache]],
+    get_line_ranges: t.Callable[[pathlib.Path], t.Optional[LineRanges]],
+    stopped: t.Callable[[], bool],
+) -> t.Iterable[t.Tuple[pathlib.Path, t.Callable[[], _FileResult]]]:
+    from concurrent.futures import Future, wait
+
+    # `files` may still be collected while we go, so walking directories
+    # overlaps with processing the files found so far
+    pending = collections.deque()
+    submitted = set()
+    with _Pipeline(config.jobs) as pipeline:
+        for file in files:
+            file_config = config.for_directory(file.parent)
+            cache = get_cache(file_config)
+            if cache is not None and cache.is_clean(file):
+                future = Future()
+                future.set_result(_up_to_date(file, file_config))
+            else:
+                future = pipeline.submit(file, file_config, get_line_ranges(file))
+                submitted.add(future)
+            pending.append((file, future))
+            # report results as soon as they are available, in order, and stop
+            # reading more files once enough of them are pending
+            while pending and (pending[0][1].done() or len(pending) >= PIPELINE_WINDOW):
+                file, future = pending.popleft()
+                yield file, future.result
+                if stopped():
+                    break
+            if stopped():
+                break
+        while pending and not stopped():
+            file, future = pending.popleft()
+            yield file, future.result
+        if pending:
+            # files which are already being written when stopping early
+            pipeline.stop()
+            wait([future for __, future in pending])
+            for file, future in pending:
+                if future in submitted and not future.cancelled():
+                    yield file, future.result
+
+
+class _Pipeline:
+    """Process files with reading and writing them overlapping processing.
+
+    An asyncio event loop in a separate thread moves each file through the
+    stages: reading and writing happens in a pool of threads, since these
+    mostly wait for the filesystem, while the CPU-bound processing happens
+    in a separate executor (a single thread or `jobs` processes).
+    """
+
+    def __init__(self, jobs: int):
+        import asyncio
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._io_executor = ThreadPoolExecutor(PIPELINE_IO_THREADS)
+        if jobs == 1 or sys.version_info < (3, 7):
+            # forking is not safe once the threads of the pipeline are running,
+            # and before Python 3.7 there is no way to make the process pool
+            # spawn its workers instead, so a single thread has to do
+            self._cpu_executor = ThreadPoolExecutor(1)
+        else:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            context = multiprocessing.get_context('spawn')
+            self._cpu_executor = ProcessPoolExecutor(jobs, mp_context=context)
+        self._loop = asyncio.new_event_loop()
+        self._tasks = set()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(
+        self, file: pathlib.Path, config: Config, line_ranges: t.Optional[LineRanges]
+    ):
+        # returns a `concurrent.futures.Future` for the `_FileResult`
+        from concurrent.futures import Future
+
+        future = Future()
+        self._loop.call_soon_threadsafe(
+            self._start, future, self._process(file, config, line_ranges)
+        )
+        return future
+
+    def stop(self):
+        """Stop processing files without waiting.
+
+        Files which are already being written (or streamed) are completed,
+        others are skipped before their next stage and their futures are
+        cancelled.
+        """
+        self._stopping = True
+
+    def close(self):
+        """Stop processing files and wait until all threads are done.
+
+        Files which are still being read or written are completed, but
+        those not processed yet are skipped.
+        """
+        import asyncio
+
+        async def _cancel():
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel(), self._loop).result()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._io_executor.shutdown()
+            self._cpu_executor.shutdown()
+
+    def _start(self, future, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(functools.partial(self._finish, future))
+
+    def _finish(self, future, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            future.cancel()
+            # only this wakes up `concurrent.futures.wait`
+            future.set_running_or_notify_cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def _check_stopping(self):
+        # called between the stages, so once a file is being written (or
+        # streamed) it is always completed
+        import asyncio
+
+        if self._stopping:
+            raise asyncio.CancelledError
+
+    async def _process(
+        self, file: pathlib.Path, config: Config, line_ranges: t.Optional[LineRanges]
+    ) -> _FileResult:
+        self._check_stopping()
+        start_time = time.perf_counter()
+        run = self._loop.run_in_executor
+        stat, data = await run(self._io_executor, _read_file, file, config)
+        self._check_stopping()
+        if data is None and _use_streaming(config, stat):
+            # reading and processing the file is done piece by piece
+            result = await run(
+                self._cpu_executor, _normalize_file, file, config, line_ranges
+            )
+        elif data is None:
+            result = _up_to_date(file, config, stat, quick_rejected=True)
+        else:
+            result, new_data = await run(
+                self._cpu_executor,
+                _transform_file,
+                file,
+                config,
+                line_ranges,
+                stat,
+                data,
+            )
+            if new_data is not None:
+                self._check_stopping()
+                result = await run(
+                    self._io_executor,
+                    _write_file,
+                    file,
+                    config,
+                    new_data,
+                    result,
+                    line_ranges,
+                )
+        return replace(result, duration=time.perf_counter() - start_time)
 
 
 def _expand_dirs(
-    files: t.Iterable[pathlib.Path], config: Config, check_ext: bool = False
+    files: t.Iterable[pathlib.Path],
+    config: Config,
+    on_excluded: t.Callable[[pathlib.Path], None],
 ) -> t.Iterable[pathlib.Path]:
+    # files and directories are identified by (device, inode) so we never
+    # process the same file twice, even when it can be reached through more
+    # than one argument, a symlink or a hardlink
+    seen = set()
+    is_path_excluded = timings.timed('exclude', Config.is_path_excluded)
     for file in files:
-        if config.is_path_excluded(file):
-            if config.verbose:
-                click.echo(f'{file} is excluded', err=True)
-        elif file.is_file():
-            if not check_ext or file.suffix == '.py':
+        if is_path_excluded(config.for_directory(file.parent), file):
+            on_excluded(file)
+            continue
+        st = file.stat()
+        key = (st.st_dev, st.st_ino)
+        if S_ISDIR(st.st_mode):
+            yield from _walk_dir(file, key, config, seen, on_excluded)
+        elif S_ISREG(st.st_mode) and _mark_seen(seen, key):
+            yield file
+
+
+def _mark_seen(seen: t.Set[t.Tuple[int, int]], key: t.Tuple[int, int]) -> bool:
+    # some filesystems do not have inode numbers, so we cannot detect
+    # duplicates there
+    if not key[1]:
+        return True
+    if key in seen:
+        return False
+    seen.add(key)
+    return True
+
+
+def _scan_dir(path: str) -> t.List[os.DirEntry]:
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda entry: entry.name)
+
+
+def _walk_dir(
+    root: pathlib.Path,
+    root_key: t.Tuple[int, int],
+    config: Config,
+    seen: t.Set[t.Tuple[int, int]],
+    on_excluded: t.Callable[[pathlib.Path], None],
+) -> t.Iterable[pathlib.Path]:
+    # the file type info of `DirEntry` comes from the directory listing on
+    # most systems, so unlike `Path.is_dir()` etc. we usually need no `stat`
+    # call for an entry except for directories and symlinks
+    if not _mark_seen(seen, root_key):
+        return
+    is_path_excluded = timings.timed('exclude', Config.is_path_excluded)
+    stack = [(root_key, iter(_scan_dir(root)), config.for_directory(root))]
+    ancestors = {root_key}
+    while stack:
+        dir_key, entries, dir_config = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            ancestors.discard(dir_key)
+            continue
+        if entry.is_dir():
+            path = pathlib.Path(entry.path)
+            if is_path_excluded(dir_config, path):
+                on_excluded(path)
+                continue
+            st = entry.stat()
+            key = (st.st_dev, st.st_ino)
+            if key in ancestors:
+                if config.verbose:
+                    click.echo(f'{path} is a symlink loop', err=True)
+                continue
+            if _mark_seen(seen, key):
+                entries = iter(_scan_dir(entry.path))
+                stack.append((key, entries, config.for_directory(path)))
+                ancestors.add(key)
+        elif os.path.splitext(entry.name)[1] == '.py' and entry.is_file():
+            path = pathlib.Path(entry.path)
+            if is_path_excluded(dir_config, path):
+                on_excluded(path)
+                continue
+            if entry.is_symlink():
+                st = entry.stat()
+                key = (st.st_dev, st.st_ino)
+            else:
+                # a file is always on the same device as its directory
+                key = (dir_key[0], entry.inode())
+            if _mark_seen(seen, key):
+                yield path
+
+
+def _expand_changed(
+    files: t.Iterable[pathlib.Path],
+    config: Config,
+    changed: t.Set[pathlib.Path],
+    on_excluded: t.Callable[[pathlib.Path], None],
+) -> t.Iterable[pathlib.Path]:
+    # like _expand_dirs, but without walking directories: we only check whether
+    # the changed files are inside them and not excluded
+    changed_py_files = sorted(path for path in changed if path.suffix == '.py')
+    is_path_excluded = timings.timed('exclude', Config.is_path_excluded)
+    for file in files:
+        if is_path_excluded(config.for_directory(file.parent), file):
+            on_excluded(file)
+            continue
+        resolved = file.resolve()
+        if file.is_file():
+            if resolved in changed:
                 yield file
-        elif file.is_dir():
-            yield from _expand_dirs(file.iterdir(), config, check_ext=True)
+            continue
+        for path in changed_py_files:
+            try:
+                relative = path.relative_to(resolved)
+            except ValueError:
+                continue
+            candidate = file
+            for part in relative.parts:
+                dir_config = config.for_directory(candidate)
+                if is_path_excluded(dir_config, candidate / part):
+                    break
+                candidate = candidate / part
+            else:
+                if candidate.is_file():
+                    yield candidate
+
+
+def _up_to_date(
+    file: pathlib.Path,
+    config: Config,
+    stat: t.Optional[FileStat] = None,
+    quick_rejected: bool = False,
+) -> _FileResult:
+    messages = ((f'{file} is up to date', True),) if config.verbose else ()
+    return _FileResult(False, messages, stat, quick_rejected)
+
+
+def _read_if_may_change(
+    file: pathlib.Path, size: int, double_quotes: bool
+) -> t.Optional[bytes]:
+    # returns the contents of the file unless a quick scan shows that it
+    # cannot need any changes
+    if not size:
+        return None
+    with file.open('rb') as f:
+        if size < MMAP_THRESHOLD:
+            data = f.read()
+            return data if may_change(data, double_quotes) else None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data[:] if may_change(data, double_quotes) else None
+
+
+def _process_file(
+    file: pathlib.Path, config: Config, line_ranges: t.Optional[LineRanges] = None
+) -> _FileResult:
+    start_time = time.perf_counter()
+    if config.timings:
+        timings.start()
+    try:
+        result = _normalize_file(file, config, line_ranges)
+    finally:
+        file_timings = timings.stop() if config.timings else None
+    duration = time.perf_counter() - start_time
+    return replace(result, duration=duration, timings=file_timings)
+
+
+def _normalize_file(
+    file: pathlib.Path, config: Config, line_ranges: t.Optional[LineRanges]
+) -> _FileResult:
+    stat, data = _read_file(file, config)
+    if _use_streaming(config, stat):
+        result = _stream_file(file, config, line_ranges, stat)
+        if result is not None:
+            return result
+        with timings.measure('read'):
+            data = _read_if_may_change(file, stat[1], config.double_quotes)
+    if data is None:
+        return _up_to_date(file, config, stat, quick_rejected=True)
+    result, new_data = _transform_file(file, config, line_ranges, stat, data)
+    if new_data is None:
+        return result
+    return _write_file(file, config, new_data, result, line_ranges)
 
 
-def _process_file(file: pathlib.Path, config: Config):
-    old_code = file.read_text()
-    new_code = transform_source(old_code, double_quotes=config.double_quotes)
-    if old_code == new_code:
+def _use_streaming(config: Config, stat: FileStat) -> bool:
+    # diffs need all the code anyway
+    return stat[1] >= config.stream_threshold and not config.diff and not config.patch
+
+
+def _read_file(
+    file: pathlib.Path, config: Config
+) -> t.Tuple[FileStat, t.Optional[bytes]]:
+    with timings.measure('read'):
+        stat = get_file_stat(file)
+        if _use_streaming(config, stat):
+            # the file is read while processing it
+            return stat, None
+        return stat, _read_if_may_change(file, stat[1], config.double_quotes)
+
+
+def _transform_file(
+    file: pathlib.Path,
+    config: Config,
+    line_ranges: t.Optional[LineRanges],
+    stat: FileStat,
+    data: bytes,
+) -> t.Tuple[_FileResult, t.Optional[bytes]]:
+    # everything between reading and writing the file; returns the result
+    # and the new contents of the file if it needs to be written
+    with timings.measure('decode'):
+        old_code, encoding = decode_source(data)
+    if line_ranges is not None:
+        # the file may still contain strings that need changes
+        stat = None
+
+    if config.check_only and not config.diff and not config.patch:
+        # we only need to know whether there is any literal to change
+        with timings.measure('scan'):
+            changed = needs_changes(
+                old_code,
+                double_quotes=config.double_quotes,
+                engine=config.engine,
+                line_ranges=line_ranges,
+            )
+        if not changed:
+            return _up_to_date(file, config, stat), None
+        messages = ((f'{file} needs changes', True),) if not config.quiet else ()
+        return _FileResult(True, messages, changes=None), None
+
+    with timings.measure('scan'):
+        edits = iter_edits(
+            old_code,
+            double_quotes=config.double_quotes,
+            engine=config.engine,
+            line_ranges=line_ranges,
+        )
+        first_edit = next(edits, None)
+    if first_edit is None:
+        return _up_to_date(file, config, stat), None
+
+    with timings.measure('scan'):
+        edits = [first_edit, *edits]
+    with timings.measure('serialize'):
+        new_code = apply_edits(old_code, edits)
+        if config.patch:
+            patch = _format_patch(file, old_code, new_code, edits, encoding)
+            return _FileResult(True, ((patch, False),), changes=len(edits)), None
+        if config.diff:
+            mtime = _getmtime(file)
+            diff = _format_diff(str(file), old_code, new_code, edits, mtime)
+            return _FileResult(True, ((diff, False),), changes=len(edits)), None
+        new_data = new_code.encode(encoding)
+    messages = ((f'Updated {file}', True),) if not config.quiet else ()
+    return _FileResult(True, messages, changes=len(edits)), new_data
+
+
+def _write_file(
+    file: pathlib.Path,
+    config: Config,
+    new_data: bytes,
+    result: _FileResult,
+    line_ranges: t.Optional[LineRanges],
+) -> _FileResult:
+    with timings.measure('write'):
+        _atomic_overwrite(
+            file,
+            new_data,
+            sync=config.durability == 'file',
+            preserve_mtime=config.preserve_mtime,
+        )
+        stat = get_file_stat(file) if line_ranges is None else None
+    return replace(result, clean_stat=stat)
+
+
+def _stream_file(
+    file: pathlib.Path,
+    config: Config,
+    line_ranges: t.Optional[LineRanges],
+    stat: FileStat,
+) -> t.Optional[_FileResult]:
+    # like `_normalize_file`, but without ever having the whole file in
+    # memory. returns None if the code can only be handled by the tree
+    # engine, which needs all of it
+    import io
+
+    with timings.measure('read'):
+        if not stat[1]:
+            return _up_to_date(file, config, stat, quick_rejected=True)
+        with file.open('rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if not may_change(data, config.double_quotes):
+                    return _up_to_date(file, config, stat, quick_rejected=True)
+                encoding = get_encoding(data[:STREAM_CHUNK_SIZE])
+
+    if config.check_only:
+        try:
+            with timings.measure('scan'):
+                with file.open(encoding=encoding, newline='') as source:
+                    changed = _tokens_need_changes(
+                        _iter_lines(source), config.double_quotes, line_ranges
+                    )
+        except _InvalidSource:
+            return None
+        if not changed:
+            return _up_to_date(file, config, stat if line_ranges is None else None)
+        messages = ((f'{file} needs changes', True),) if not config.quiet else ()
+        return _FileResult(True, messages, changes=None)
+
+    changes = 0
+    # length of the code before the first change, which is only written
+    # once we know that the file needs changes
+    unchanged = 0
+    output = None
+    try:
+        with ExitStack() as stack, timings.measure('scan'):
+            source = stack.enter_context(file.open(encoding=encoding, newline=''))
+            parts = _iter_transformed_parts(
+                _iter_lines(source), config.double_quotes, line_ranges
+            )
+            for old, new in parts:
+                if output is None and new == old:
+                    unchanged += len(old)
+                    continue
+                if output is None:
+                    writer = _atomic_writer(
+                        file,
+                        sync=config.durability == 'file',
+                        preserve_mtime=config.preserve_mtime,
+                    )
+                    output = io.TextIOWrapper(
+                        stack.enter_context(writer),
+                        encoding=encoding,
+                        newline='',
+                    )
+                    _copy_code(file, encoding, unchanged, output)
+                if new != old:
+                    changes += 1
+                output.write(new)
+            if output is not None:
+                # flush it while the atomic writer still has the file open
+                output.detach()
+    except _InvalidSource:
+        # the atomic writer discarded what we wrote so far
+        return None
+
+    if not changes:
+        return _up_to_date(file, config, stat if line_ranges is None else None)
+    clean_stat = get_file_stat(file) if line_ranges is None else None
+    messages = ((f'Updated {file}', True),) if not config.quiet else ()
+    return _FileResult(True, messages, clean_stat, changes=changes)
+
+
+def _iter_lines(source: t.TextIO) -> t.Iterator[str]:
+    # the lines of the code the same way `split_lines` in parso splits them
+    line = ''
+    for line in source:
+        yield line
+    if not line or line[-1] in '\r\n':
+        yield ''
+
+
+def _copy_code(file: pathlib.Path, encoding: str, length: int, output: t.TextIO):
+    with file.open(encoding=encoding, newline='') as source:
+        while length:
+            chunk = source.read(min(length, STREAM_CHUNK_SIZE))
+            output.write(chunk)
+            length -= len(chunk)
+
+
+def _process_stdin(config: Config) -> bool:
+    if not config.timings:
+        return _normalize_stdin(config)
+    timings.start()
+    try:
+        return _normalize_stdin(config)
+    finally:
+        file_timings = timings.stop()
+        _report_timings(config, {}, {config.stdin_filename or '-': file_timings})
+
+
+def _normalize_stdin(config: Config) -> bool:
+    name = config.stdin_filename or '-'
+    with timings.measure('read'):
+        data = click.get_binary_stream('stdin').read()
+    # not using click.echo since it strips ANSI codes when not writing to a tty
+    stdout = click.get_binary_stream('stdout')
+    if config.stdin_filename and config.is_path_or_parent_excluded(
+        pathlib.Path(config.stdin_filename)
+    ):
         if config.verbose:
-            click.echo(f'{file} is up to date', err=True)
+            click.echo(f'{name} is excluded', err=True)
+        if not config.diff and not config.patch and not config.check_only:
+            stdout.write(data)
         return False
 
-    if config.diff:
-        diff_lines = difflib.unified_diff(
-            old_code.splitlines(),
-            new_code.splitlines(),
-            f'{file}:before',
-            f'{file}:after',
-            _getmtime(file),
-            _getmtime(None),
-            lineterm='',
+    with timings.measure('decode'):
+        old_code, encoding = decode_source(data)
+    if config.check_only and not config.diff and not config.patch:
+        with timings.measure('scan'):
+            changed = needs_changes(
+                old_code,
+                double_quotes=config.double_quotes,
+                engine=config.engine,
+                line_ranges=config.line_ranges,
+            )
+        if changed and not config.quiet:
+            click.echo(f'{name} needs changes', err=True)
+        elif not changed and config.verbose:
+            click.echo(f'{name} is up to date', err=True)
+        return changed
+
+    with timings.measure('scan'):
+        edits = list(
+            iter_edits(
+                old_code,
+                double_quotes=config.double_quotes,
+                engine=config.engine,
+                line_ranges=config.line_ranges,
+            )
         )
-        click.echo('\n'.join(diff_lines))
-        return True
+    with timings.measure('serialize'):
+        new_code = apply_edits(old_code, edits)
+        changed = old_code != new_code
+        output = None
+        if config.patch:
+            if changed:
+                path = pathlib.Path(name)
+                output = _format_patch(path, old_code, new_code, edits, encoding)
+        elif config.diff:
+            if changed:
+                mtime = _getmtime(None)
+                output = _format_diff(name, old_code, new_code, edits, mtime)
+        else:
+            output = new_code.encode(encoding) if changed else data
+    with timings.measure('write'):
+        if config.patch or config.diff:
+            if output is not None:
+                click.echo(output)
+        else:
+            stdout.write(output)
+    if not changed and config.verbose:
+        click.echo(f'{name} is up to date', err=True)
+    return changed
 
-    if config.check_only:
-        if not config.quiet:
-            click.echo(f'{file} needs changes', err=True)
-        return True
 
-    _atomic_overwrite(file, new_code)
-    if not config.quiet:
-        click.echo(f'Updated {file}', err=True)
-    return True
+def _report_timings(
+    config: Config,
+    global_timings: t.Dict[str, float],
+    file_timings: t.Dict[str, t.Dict[str, float]],
+):
+    report = timings.get_report(global_timings, file_timings)
+    click.echo(timings.format_report(report), err=True)
+    if config.timings_json:
+        import json
+
+        with open(config.timings_json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def _format_diff(
+    name: str, old_code: str, new_code: str, edits: t.List[Edit], old_mtime: str
+) -> str:
+    diff_lines = unified_diff(
+        old_code,
+        new_code,
+        edits,
+        f'{name}:before',
+        f'{name}:after',
+        old_mtime,
+        _getmtime(None),
+    )
+    return '\n'.join(diff_lines)
+
+
+def _format_patch(
+    file: pathlib.Path,
+    old_code: str,
+    new_code: str,
+    edits: t.List[Edit],
+    encoding: str,
+) -> bytes:
+    if file.is_absolute():
+        try:
+            file = file.relative_to(pathlib.Path.cwd())
+        except ValueError:
+            pass
+    patch = format_patch(file.as_posix(), old_code, new_code, edits)
+    # use the encoding of the file so the patch applies cleanly; the final
+    # newline is added back when echoing it
+    return patch.encode(encoding)[:-1]
+
+
+def _atomic_overwrite(
+    file: pathlib.Path, content: bytes, sync: bool = False, preserve_mtime: bool = False
+):
+    with _atomic_writer(file, sync, preserve_mtime) as f:
+        f.write(content)
 
 
-def _atomic_overwrite(file: pathlib.Path, content: str):
-    tmp_file = file.with_suffix(f'{file.suffix}.pyquoted')
-    tmp_file.touch()
-    shutil.copymode(file, tmp_file)
-    tmp_file.write_text(content)
+@contextmanager
+def _atomic_writer(
+    file: pathlib.Path, sync: bool = False, preserve_mtime: bool = False
+) -> t.Iterator[t.BinaryIO]:
+    # the file is only replaced if writing the new contents succeeded
+    stat = file.stat()
+    fd, tmp_file = _create_temp_file(file, S_IMODE(stat.st_mode))
+    try:
+        with open(fd, 'wb') as f:
+            yield f
+            f.flush()
+            if preserve_mtime:
+                times = (stat.st_atime_ns, stat.st_mtime_ns)
+                os.utime(fd if os.utime in os.supports_fd else tmp_file, ns=times)
+            if sync:
+                os.fsync(fd)
+    except BaseException:
+        tmp_file.unlink()
+        raise
     tmp_file.replace(file)
+    if sync:
+        _fsync_path(file.parent)
+
+
+def _create_temp_file(file: pathlib.Path, mode: int) -> t.Tuple[int, pathlib.Path]:
+    # creates an empty file next to `file` with the given permissions; the
+    # name is random so concurrent runs never write to the same file
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    for __ in range(TEMP_FILE_ATTEMPTS):
+        tmp_file = file.with_name(f'{file.name}.{os.urandom(4).hex()}.pyquoted')
+        try:
+            fd = os.open(tmp_file, flags, mode)
+        except FileExistsError:
+            continue
+        try:
+            # the umask may have removed some of the permissions
+            if hasattr(os, 'fchmod') and S_IMODE(os.fstat(fd).st_mode) != mode:
+                os.fchmod(fd, mode)
+        except BaseException:
+            os.close(fd)
+            tmp_file.unlink()
+            raise
+        return fd, tmp_file
+    raise FileExistsError(f'No unused temporary file name found for {file}')
+
+
+def _sync_files(files: t.Iterable[pathlib.Path]):
+    # syncs the data of the files first, and then their directories so the
+    # renamed files are on disk as well
+    directories = set()
+    for file in files:
+        _fsync_path(file)
+        directories.add(file.parent)
+    for directory in sorted(directories):
+        _fsync_path(directory)
+
+
+def _fsync_path(path: pathlib.Path):
+    if os.name == 'nt' and path.is_dir():  # pragma: no cover
+        # directories cannot be opened (nor synced) on windows
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def _getmtime(path: t.Optional[pathlib.Path]) -> str:  # pragma: no cover
+    from datetime import datetime
+
     if path is None:
         return datetime.now().isoformat()
     return datetime.fromtimestamp(path.stat().st_mtime).isoformat()
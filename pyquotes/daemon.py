@@ -0,0 +1,258 @@
+import os
+import signal
+import socketserver
+import sys
+import threading
+import typing as t
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import click
+
+import pyquotes
+from pyquotes.settings import CONFIG_SOURCES, Config, _as_bool
+from pyquotes.transform import ENGINES, transform_source
+
+
+DEFAULT_PORT = 45431
+# number of directories whose config is kept
+CONFIG_CACHE_SIZE = 1024
+
+# request headers
+DOUBLE_QUOTES_HEADER = 'X-Double-Quotes'
+ENGINE_HEADER = 'X-Engine'
+FILENAME_HEADER = 'X-Filename'
+
+
+class _RequestError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+class _ConfigCache:
+    # resolves the configs of all files through one long-lived config per
+    # combination of settings, so each directory is only looked up (and each
+    # config file parsed) once, until the config files of its project root
+    # change or too many directories have been seen
+
+    def __init__(self, max_size: int = CONFIG_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._defaults: t.Dict[t.Tuple, Config] = {}
+        self._configs: t.Dict[t.Tuple, t.Tuple[Config, t.Tuple]] = {}
+
+    def get(self, settings: t.Dict[str, t.Any], path: Path) -> t.Optional[Config]:
+        """Get the config for `path`, or None if the file is excluded."""
+        key = tuple(sorted(settings.items()))
+        directory = path.parent.absolute()
+        with self._lock:
+            cached = self._configs.get((key, directory))
+            if cached is not None:
+                config, stamp = cached
+                if _stamp_config_files(config.project_root) != stamp:
+                    # start over, as the change may affect other directories
+                    # (or settings) with the same project root as well
+                    self._clear()
+                    cached = None
+            if cached is None:
+                if len(self._configs) >= self._max_size:
+                    self._clear()
+                config = self._resolve(settings, key, directory)
+                stamp = _stamp_config_files(config.project_root)
+                self._configs[(key, directory)] = config, stamp
+            if config.is_path_or_parent_excluded(path):
+                return None
+        return config
+
+    def _resolve(self, settings, key, directory) -> Config:
+        default = self._defaults.get(key)
+        if default is None:
+            # a project root which cannot exist, so we know when no config
+            # was found for a directory
+            default = Config(settings, _found=(Path(os.devnull), {}))
+            self._defaults[key] = default
+        config = default.for_directory(directory)
+        if config is default:
+            # like for the CLI, the directory of a file outside of any
+            # project is its project root
+            config = Config(settings, _found=(directory, {}))
+        return config
+
+    def _clear(self):
+        # the defaults memoize all lookups, so they are dropped as well
+        self._defaults.clear()
+        self._configs.clear()
+
+
+def _stamp_config_files(project_root: Path) -> t.Tuple:
+    stamp = []
+    for name in CONFIG_SOURCES:
+        try:
+            stat = (Path(project_root) / name).stat()
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = f'pyquotesd/{pyquotes.__version__}'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send(404, 'not found\n')
+            return
+        self._send(200, 'ok\n')
+
+    def do_POST(self):
+        if self.path != '/':
+            self._send(404, 'not found\n')
+            return
+        try:
+            source = self._read_source()
+            kwargs = self._get_transform_args()
+        except _RequestError as exc:
+            self._send(exc.status, f'{exc.message}\n')
+            return
+        if kwargs is None:
+            # excluded file
+            self._send(204)
+            return
+        try:
+            new_source = transform_source(source, **kwargs)
+        except Exception as exc:
+            self._send(500, f'{type(exc).__name__}: {exc}\n')
+            return
+        if new_source == source:
+            self._send(204)
+        else:
+            self._send(200, new_source)
+
+    def _read_source(self) -> str:
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise _RequestError(400, 'invalid content length')
+        charset = self.headers.get_content_charset('utf-8')
+        try:
+            return self.rfile.read(length).decode(charset)
+        except (LookupError, UnicodeDecodeError) as exc:
+            raise _RequestError(400, f'could not decode request body: {exc}')
+
+    def _get_transform_args(self) -> t.Optional[t.Dict[str, t.Any]]:
+        settings = {}
+        double_quotes = self.headers.get(DOUBLE_QUOTES_HEADER)
+        if double_quotes is not None:
+            try:
+                settings['double_quotes'] = _as_bool(double_quotes)
+            except ValueError:
+                raise _RequestError(400, f'invalid {DOUBLE_QUOTES_HEADER} header')
+        engine = self.headers.get(ENGINE_HEADER, 'tree')
+        if engine not in ENGINES:
+            raise _RequestError(400, f'invalid {ENGINE_HEADER} header')
+        filename = self.headers.get(FILENAME_HEADER)
+        if filename is None:
+            double_quotes = settings.get('double_quotes', False)
+            return {'double_quotes': double_quotes, 'engine': engine}
+        config = self.server.configs.get(settings, Path(filename))
+        if config is None:
+            return None
+        return {'double_quotes': config.double_quotes, 'engine': engine}
+
+    def _send(self, status: int, body: str = ''):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        if status != 204:
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if status != 204:
+            self.wfile.write(data)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    quiet = False
+
+
+class _ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+    quiet = False
+
+
+def make_server(
+    host: str = 'localhost', port: int = DEFAULT_PORT, unix_socket: str = None
+) -> socketserver.BaseServer:
+    if unix_socket is not None:
+        server = _ThreadingUnixHTTPServer(unix_socket, _Handler)
+    else:
+        server = _ThreadingHTTPServer((host, port), _Handler)
+    server.configs = _ConfigCache()
+    # load the parser grammar now so the first request is just as fast as
+    # the following ones
+    transform_source('"warmup"\n')
+    return server
+
+
+@click.command()
+@click.version_option(pyquotes.__version__, '--version', '-V')
+@click.help_option('--help', '-h')
+@click.option(
+    '--bind-host',
+    default='localhost',
+    show_default=True,
+    help='Address to bind the server to.',
+)
+@click.option(
+    '--bind-port',
+    type=int,
+    default=DEFAULT_PORT,
+    show_default=True,
+    help='Port to listen on.',
+)
+@click.option(
+    '--bind-unix',
+    metavar='PATH',
+    help='Listen on this unix socket instead of a TCP port.',
+)
+@click.option('--quiet', '-q', is_flag=True, help='Do not log requests.')
+def main(bind_host: str, bind_port: int, bind_unix: t.Optional[str], quiet: bool):
+    """
+    A server that normalizes the quotes in the Python code sent to it.
+
+    POST the code to "/" to get back the updated code (200) or an empty
+    response if no changes were needed (204). The "X-Double-Quotes" header
+    selects the preferred quotes and "X-Engine" the engine. If the
+    "X-Filename" header is set, the config of that file is used and nothing
+    is changed if the file is excluded.
+
+    "/health" can be used to check whether the server is running.
+    """
+    server = make_server(bind_host, bind_port, bind_unix)
+    server.quiet = quiet
+    # make sure the cleanup below also happens when we get terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if not quiet:
+        where = bind_unix or f'http://{bind_host}:{server.server_address[1]}'
+        click.echo(f'pyquotesd {pyquotes.__version__} listening on {where}', err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+        if bind_unix is not None:
+            Path(bind_unix).unlink()
@@ -0,0 +1,215 @@
+import bisect
+import itertools
+import typing as t
+from collections import Counter
+
+from pyquotes.transform import Edit
+
+
+# lines of context around changes, same as the default of `diff -u`
+CONTEXT_LINES = 3
+
+# (tag, i1, i2, j1, j2) like the opcodes of difflib.SequenceMatcher
+_Opcode = t.Tuple[str, int, int, int, int]
+
+
+def unified_diff(
+    old: str,
+    new: str,
+    edits: t.Sequence[Edit],
+    fromfile: str,
+    tofile: str,
+    fromfiledate: str = '',
+    tofiledate: str = '',
+) -> t.Iterator[str]:
+    """Get a unified diff between the original and the normalized code.
+
+    The output is identical to that of ``difflib.unified_diff`` on the
+    ``splitlines()`` of both versions (using ``lineterm=''``), but instead
+    of comparing the whole files the hunks are built from the lines touched
+    by `edits`, which is much faster for large files.
+    """
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    opcodes = None
+    if len(old_lines) == len(new_lines):
+        changed = _get_changed_lines(old.splitlines(keepends=True), edits)
+        changed = [i for i in changed if old_lines[i] != new_lines[i]]
+        opcodes = _get_difflib_opcodes(old_lines, new_lines, changed)
+    if opcodes is None:
+        import difflib
+
+        yield from difflib.unified_diff(
+            old_lines,
+            new_lines,
+            fromfile,
+            tofile,
+            fromfiledate,
+            tofiledate,
+            lineterm='',
+        )
+        return
+    fromdate = f'\t{fromfiledate}' if fromfiledate else ''
+    todate = f'\t{tofiledate}' if tofiledate else ''
+    for i, group in enumerate(_group_opcodes(opcodes)):
+        if i == 0:
+            yield f'--- {fromfile}{fromdate}'
+            yield f'+++ {tofile}{todate}'
+        yield from _format_hunk(group, old_lines, new_lines)
+
+
+def format_patch(path: str, old: str, new: str, edits: t.Sequence[Edit]) -> str:
+    """Get a git-style patch for the changes to a single file.
+
+    Unlike :func:`unified_diff` the original line endings are kept, so the
+    patch can be applied using ``git apply`` or ``patch -p1``. Patches of
+    several files can simply be concatenated.
+    """
+    old_lines = _join_non_lf_lines(old.splitlines(keepends=True))
+    new_lines = _join_non_lf_lines(new.splitlines(keepends=True))
+    changed = _get_changed_lines(old_lines, edits)
+    changed = [i for i in changed if old_lines[i] != new_lines[i]]
+    opcodes = _get_opcodes(len(old_lines), changed, lambda i: True)
+    parts = [f'diff --git a/{path} b/{path}\n', f'--- a/{path}\n', f'+++ b/{path}\n']
+    for group in _group_opcodes(opcodes):
+        lines = _format_hunk(group, old_lines, new_lines)
+        parts.append(next(lines) + '\n')
+        for line in lines:
+            if not line.endswith('\n'):
+                line += '\n\\ No newline at end of file\n'
+            parts.append(line)
+    return ''.join(parts)
+
+
+def _join_non_lf_lines(lines: t.List[str]) -> t.List[str]:
+    # lines in a patch can only be separated by \n, so other line breaks
+    # recognized by str.splitlines (\r, \f etc.) must not split lines there
+    if all(line.endswith('\n') for line in lines[:-1]):
+        return lines
+    result = []
+    pending = ''
+    for line in lines:
+        pending += line
+        if pending.endswith('\n'):
+            result.append(pending)
+            pending = ''
+    if pending:
+        result.append(pending)
+    return result
+
+
+def _get_changed_lines(lines: t.Sequence[str], edits: t.Iterable[Edit]) -> t.List[int]:
+    # normalizing strings never adds or removes line breaks, so lines not
+    # touched by any edit are the same in both versions
+    line_ends = list(itertools.accumulate(len(line) for line in lines))
+    changed = set()
+    for edit in edits:
+        first = bisect.bisect_right(line_ends, edit.start)
+        last = bisect.bisect_right(line_ends, edit.end - 1)
+        changed.update(range(first, last + 1))
+    return sorted(changed)
+
+
+def _get_difflib_opcodes(
+    old_lines: t.Sequence[str], new_lines: t.Sequence[str], changed: t.List[int]
+) -> t.Optional[t.List[_Opcode]]:
+    # difflib.SequenceMatcher (with autojunk) ignores "popular" lines, i.e.
+    # those appearing more than 1% of the time in files of 200+ lines, when
+    # looking for matches, so a block of unchanged lines only matches if it
+    # contains some other line
+    popular = set()
+    new_counts = Counter(new_lines)
+    if len(new_lines) >= 200:
+        threshold = len(new_lines) // 100 + 1
+        popular = {line for line, count in new_counts.items() if count > threshold}
+    # if a changed line is identical to some other line, difflib may match
+    # those instead of the unchanged lines at the same position, so we need
+    # to let it do the whole comparison
+    old_set = None
+    for i in changed:
+        if old_lines[i] in new_counts and old_lines[i] not in popular:
+            return None
+        if new_lines[i] not in popular:
+            if old_set is None:
+                old_set = set(old_lines)
+            if new_lines[i] in old_set:
+                return None
+    return _get_opcodes(len(old_lines), changed, lambda i: new_lines[i] not in popular)
+
+
+def _get_opcodes(
+    num_lines: int, changed: t.List[int], matchable: t.Callable[[int], bool]
+) -> t.List[_Opcode]:
+    # a run of unchanged lines is only kept as such if it contains a
+    # `matchable` line; like in difflib the one at the start of the file
+    # is always kept
+    blocks = []
+    start = 0
+    for end in [*changed, num_lines]:
+        if start < end and (not start or any(map(matchable, range(start, end)))):
+            blocks.append((start, end))
+        start = end + 1
+    opcodes = []
+    pos = 0
+    for start, end in blocks:
+        if pos < start:
+            opcodes.append(('replace', pos, start, pos, start))
+        opcodes.append(('equal', start, end, start, end))
+        pos = end
+    if pos < num_lines:
+        opcodes.append(('replace', pos, num_lines, pos, num_lines))
+    return opcodes
+
+
+def _group_opcodes(opcodes: t.List[_Opcode]) -> t.Iterator[t.List[_Opcode]]:
+    # taken from difflib.SequenceMatcher.get_grouped_opcodes (PSF-licensed)
+    n = CONTEXT_LINES
+    codes = list(opcodes)
+    if not codes:
+        return
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    # taken from difflib (PSF-licensed)
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return str(beginning)
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+
+def _format_hunk(
+    group: t.List[_Opcode], old_lines: t.Sequence[str], new_lines: t.Sequence[str]
+) -> t.Iterator[str]:
+    first, last = group[0], group[-1]
+    old_range = _format_range(first[1], last[2])
+    new_range = _format_range(first[3], last[4])
+    yield f'@@ -{old_range} +{new_range} @@'
+    for tag, i1, i2, j1, j2 in group:
+        if tag == 'equal':
+            for line in old_lines[i1:i2]:
+                yield f' {line}'
+            continue
+        for line in old_lines[i1:i2]:
+            yield f'-{line}'
+        for line in new_lines[j1:j2]:
+            yield f'+{line}'
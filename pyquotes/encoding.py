@@ -0,0 +1,40 @@
+import codecs
+import typing as t
+
+
+def decode_source(data: bytes) -> t.Tuple[str, str]:
+    """Decode Python source code.
+
+    The encoding is detected from a BOM or a PEP 263 coding cookie and
+    defaults to UTF-8. Unlike reading a file in text mode, newlines are
+    kept as they are, so encoding the code again gives back the original
+    data.
+
+    Returns the code and its encoding.
+    """
+    encoding = get_encoding(data)
+    return data.decode(encoding), encoding
+
+
+def get_encoding(data: bytes) -> str:
+    """Detect the encoding of Python source code.
+
+    Only the first two lines of `data` are needed for this.
+    """
+    # the common case of a plain UTF-8 file does not need the tokenize module
+    if not data.startswith(codecs.BOM_UTF8) and b'coding' not in _first_lines(data):
+        return 'utf-8'
+
+    from io import BytesIO
+    from tokenize import detect_encoding
+
+    encoding, __ = detect_encoding(BytesIO(data).readline)
+    return encoding
+
+
+def _first_lines(data: bytes) -> bytes:
+    # a coding cookie is only valid on the first two lines
+    end = data.find(b'\n')
+    if end != -1:
+        end = data.find(b'\n', end + 1)
+    return data if end == -1 else data[:end]
@@ -0,0 +1,109 @@
+import ast
+import re
+import subprocess
+import typing as t
+from pathlib import Path
+
+
+_HUNK_HEADER_RE = re.compile(r'^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class GitError(Exception):
+    pass
+
+
+def _git(*args: str, cwd: Path) -> str:
+    try:
+        proc = subprocess.run(
+            ('git', *args),
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as exc:
+        raise GitError(f'could not run git: {exc}')
+    if proc.returncode:
+        stderr = proc.stderr.decode('utf-8', 'replace').strip()
+        raise GitError(stderr or f'git {args[0]} failed')
+    return proc.stdout.decode('utf-8', 'surrogateescape')
+
+
+def _split_paths(output: str, root: Path) -> t.Set[Path]:
+    return {root / name for name in output.split('\0') if name}
+
+
+def _unquote_path(path: str) -> str:
+    # git quotes unusual paths using C-style escapes (octal for non-ascii)
+    if path.startswith('"'):
+        return ast.literal_eval(f'b{path}').decode('utf-8')
+    return path
+
+
+def _get_merge_base(ref: str, cwd: Path) -> t.Tuple[Path, str]:
+    root = Path(_git('rev-parse', '--show-toplevel', cwd=cwd).strip()).resolve()
+    base = _git('merge-base', ref, 'HEAD', cwd=cwd).strip()
+    return root, base
+
+
+def get_changed_files(ref: str, cwd: Path) -> t.Set[Path]:
+    """Get the files that were added or modified since `ref`.
+
+    Changes are relative to the merge base of `ref` and ``HEAD``, so only
+    changes made on the current branch are considered. Uncommitted and
+    untracked (but not ignored) files are included as well.
+
+    The returned paths are absolute and fully resolved.
+    """
+    root, base = _get_merge_base(ref, cwd)
+    diff = _git(
+        'diff', '--name-only', '--diff-filter=d', '--no-renames', '-z', base, cwd=root
+    )
+    untracked = _git('ls-files', '--others', '--exclude-standard', '-z', cwd=root)
+    return _split_paths(diff, root) | _split_paths(untracked, root)
+
+
+def get_changed_lines(
+    ref: str, cwd: Path
+) -> t.Dict[Path, t.Optional[t.List[t.Tuple[int, int]]]]:
+    """Get the lines that were added or modified since `ref`.
+
+    This uses the same logic as :func:`get_changed_files` and returns a dict
+    mapping each changed file to a list of inclusive line ranges, or to
+    ``None`` for untracked files since all their lines are new.
+    """
+    root, base = _get_merge_base(ref, cwd)
+    diff = _git(
+        'diff',
+        '-U0',
+        '--no-color',
+        '--no-renames',
+        '--no-ext-diff',
+        '--src-prefix=a/',
+        '--dst-prefix=b/',
+        base,
+        cwd=root,
+    )
+    changed = {}
+    ranges = None
+    hunk_lines = 0
+    for line in diff.split('\n'):
+        if hunk_lines:
+            # skip the contents of the hunk which may look like headers
+            if not line.startswith('\\'):
+                hunk_lines -= 1
+        elif line.startswith('+++ '):
+            name = _unquote_path(line[4:])
+            ranges = None if name == '/dev/null' else []
+            if ranges is not None:
+                changed[root / name[2:]] = ranges
+        elif line.startswith('@@ '):
+            match = _HUNK_HEADER_RE.match(line)
+            old_count, first, count = match.groups()
+            count = int(count or 1)
+            hunk_lines = int(old_count or 1) + count
+            if count and ranges is not None:
+                first = int(first)
+                ranges.append((first, first + count - 1))
+    untracked = _git('ls-files', '--others', '--exclude-standard', '-z', cwd=root)
+    changed.update(dict.fromkeys(_split_paths(untracked, root)))
+    return changed
@@ -9,13 +9,104 @@ STRING_PREFIX_CHARS = 'furbFURB'
 D3 = '"""'
 S3 = "'''"
 
+# Anything that could be a string normalize_string_prefix or normalize_string_quotes
+# would change: a prefix that gets normalized, a string using the other quotes
+# (or a triple-quoted docstring using the other quotes), or an escaped quote
+# which could be avoided by switching quotes.
+_MAY_CHANGE_PREFIX = r'''[uUFB][rRbBfF]?['"]|[rRbBfF][uUFB]['"]'''
+_MAY_CHANGE_SINGLE = '|'.join(('"', S3, r"\\'", _MAY_CHANGE_PREFIX))
+_MAY_CHANGE_DOUBLE = '|'.join(("'", r'\\"', _MAY_CHANGE_PREFIX))
+_MAY_CHANGE_REGEXES = {
+    (str, False): re.compile(_MAY_CHANGE_SINGLE),
+    (str, True): re.compile(_MAY_CHANGE_DOUBLE),
+    (bytes, False): re.compile(_MAY_CHANGE_SINGLE.encode('ascii')),
+    (bytes, True): re.compile(_MAY_CHANGE_DOUBLE.encode('ascii')),
+}
+# encodings in which the ASCII characters we look for are not single bytes
+_NON_ASCII_BOMS = (b'\xff\xfe', b'\xfe\xff')
+
+
+def may_change(data, double_quotes=False):
+    """Check whether normalizing the quotes could change anything.
+
+    This is a conservative check on the raw source (``str``, ``bytes`` or
+    anything else supporting the buffer protocol, e.g. a memory-mapped
+    file) which never returns ``False`` if there is something to normalize.
+    """
+    if isinstance(data, str):
+        regex = _MAY_CHANGE_REGEXES[str, double_quotes]
+    else:
+        if data[:2] in _NON_ASCII_BOMS:
+            return True
+        regex = _MAY_CHANGE_REGEXES[bytes, double_quotes]
+    return regex.search(data) is not None
+
 
 def _sub_twice(regex, replacement, original):
     return regex.sub(replacement, regex.sub(replacement, original))
 
 
+def _compile_quote_regexes(quote):
+    return (
+        re.compile(rf'(([^\\]|^)(\\\\)*){quote}'),
+        re.compile(rf'([^\\]|^)\\((?:\\\\)*){quote}'),
+    )
+
+
+# (unescaped, escaped) regexes for triple quotes; single quotes are handled
+# without regexes, but with triple quotes their behavior for sequences of 4+
+# quotes cannot be reproduced that easily
+_TRIPLE_QUOTE_REGEXES = {q: _compile_quote_regexes(q) for q in (D3, S3)}
+_PREFIX_REGEX = re.compile(rf'^([{STRING_PREFIX_CHARS}]*)(.*)$', re.DOTALL)
+_FSTRING_EXPR_REGEX = re.compile(
+    r'''
+    (?:[^{]|^)\{  # start of the string or a non-{ followed by a single {
+        ([^{].*?)  # contents of the brackets except if begins with {{
+    \}(?:[^}]|$)  # A } followed by end of the string or a non-}
+    ''',
+    re.VERBOSE,
+)
+
+
+def _is_escaped(part):
+    # whether the character following `part` is escaped, i.e. whether
+    # `part` ends with an odd number of backslashes
+    return (len(part) - len(part.rstrip('\\'))) % 2 == 1
+
+
+def _has_unescaped_quote(body, quote):
+    if len(quote) == 3:
+        return _TRIPLE_QUOTE_REGEXES[quote][0].search(body) is not None
+    parts = body.split(quote)
+    return any(not _is_escaped(part) for part in parts[:-1])
+
+
+def _unescape_quote(body, quote):
+    if '\\' not in body:
+        return body
+    if len(quote) == 3:
+        return _sub_twice(_TRIPLE_QUOTE_REGEXES[quote][1], rf'\1\2{quote}', body)
+    parts = body.split(quote)
+    for i, part in enumerate(parts[:-1]):
+        if _is_escaped(part):
+            parts[i] = part[:-1]
+    return quote.join(parts)
+
+
+def _escape_quote(body, quote):
+    if quote not in body:
+        return body
+    if len(quote) == 3:
+        return _sub_twice(_TRIPLE_QUOTE_REGEXES[quote][0], rf'\1\\{quote}', body)
+    parts = body.split(quote)
+    for i, part in enumerate(parts[:-1]):
+        if not _is_escaped(part):
+            parts[i] = part + '\\'
+    return quote.join(parts)
+
+
 def normalize_string_prefix(leaf):
-    match = re.match(r'^([' + STRING_PREFIX_CHARS + r']*)(.*)$', leaf.value, re.DOTALL)
+    match = _PREFIX_REGEX.match(leaf.value)
     assert match is not None, f'failed to match string {leaf.value!r}'
     orig_prefix = match.group(1)
     # XXX: r isn't casefolded on purpose - https://github.com/psf/black/issues/1244
@@ -59,13 +150,13 @@ def normalize_string_quotes(leaf, is_doc, double_quotes=False):
     assert first_quote_pos != -1
 
     prefix = leaf.value[:first_quote_pos]
-    unescaped_new_quote = re.compile(rf'(([^\\]|^)(\\\\)*){new_quote}')
-    escaped_new_quote = re.compile(rf'([^\\]|^)\\((?:\\\\)*){new_quote}')
-    escaped_orig_quote = re.compile(rf'([^\\]|^)\\((?:\\\\)*){orig_quote}')
     body = leaf.value[(first_quote_pos + len(orig_quote)) : -len(orig_quote)]
 
-    if 'r' in prefix.casefold():
-        if unescaped_new_quote.search(body):
+    if '\\' not in body and new_quote not in body:
+        # nothing to escape or unescape, so just swap the quotes
+        new_body = body
+    elif 'r' in prefix.casefold():
+        if _has_unescaped_quote(body, new_quote):
             # There's at least one unescaped new_quote in this raw string
             # so converting is impossible
             return
@@ -74,24 +165,16 @@ def normalize_string_quotes(leaf, is_doc, double_quotes=False):
         new_body = body
     else:
         # remove unnecessary escapes
-        new_body = _sub_twice(escaped_new_quote, rf'\1\2{new_quote}', body)
+        new_body = _unescape_quote(body, new_quote)
         if body != new_body:
             # Consider the string without unnecessary escapes as the original
             body = new_body
             leaf.value = f'{prefix}{orig_quote}{body}{orig_quote}'
-        new_body = _sub_twice(escaped_orig_quote, rf'\1\2{orig_quote}', new_body)
-        new_body = _sub_twice(unescaped_new_quote, rf'\1\\{new_quote}', new_body)
+        new_body = _unescape_quote(new_body, orig_quote)
+        new_body = _escape_quote(new_body, new_quote)
 
     if 'f' in prefix.casefold():
-        matches = re.findall(
-            r'''
-            (?:[^{]|^)\{  # start of the string or a non-{ followed by a single {
-                ([^{].*?)  # contents of the brackets except if begins with {{
-            \}(?:[^}]|$)  # A } followed by end of the string or a non-}
-            ''',
-            new_body,
-            re.VERBOSE,
-        )
+        matches = _FSTRING_EXPR_REGEX.findall(new_body)
         for m in matches:
             if '\\' in str(m):
                 # Do not introduce backslashes in interpolated expressions
@@ -1,18 +1,13 @@
 import os
+import re
 import typing as t
 from configparser import ConfigParser
 from dataclasses import dataclass
-from fnmatch import fnmatch
+from fnmatch import translate
 from pathlib import Path
 from warnings import warn
 
 
-try:
-    import toml
-except ImportError:  # pragma: no cover
-    toml = None
-
-
 # exclude/skip lists from isort+flake8
 DEFAULT_EXCLUDE = frozenset(
     {
@@ -77,7 +72,24 @@ class _Config:
     quiet: bool = False
     verbose: bool = False
     diff: bool = False
+    patch: bool = False
     check_only: bool = False
+    fail_fast: bool = False
+    format: str = 'text'
+    jobs: t.Optional[int] = None
+    pipeline: bool = False
+    stream_threshold: int = 16 * 1024 * 1024
+    durability: str = 'none'
+    preserve_mtime: bool = False
+    engine: str = 'tree'
+    changed_since: t.Optional[str] = None
+    changed_lines: bool = False
+    line_ranges: t.Optional[t.Tuple[t.Tuple[int, int], ...]] = None
+    stdin_filename: t.Optional[str] = None
+    no_cache: bool = False
+    timings: bool = False
+    timings_json: t.Optional[str] = None
+    profile: t.Optional[str] = None
     # runtime data:
     project_root: Path = None
 
@@ -86,15 +98,63 @@ class _Config:
         object.__setattr__(self, 'extend_exclude', frozenset(self.extend_exclude))
         if self.quiet and self.verbose:
             raise ValueError('quiet and verbose are mutually exclusive')
+        if self.diff and self.patch:
+            raise ValueError('diff and patch are mutually exclusive')
+        if self.format == 'ndjson' and (self.diff or self.patch):
+            raise ValueError('ndjson format cannot be combined with diff or patch')
+        if self.fail_fast and not (self.check_only or self.diff or self.patch):
+            # files already being written in parallel could not be reported
+            raise ValueError('fail-fast requires check-only, diff or patch')
+        if self.changed_lines and not self.changed_since:
+            raise ValueError('changed-lines requires changed-since')
+        if self.changed_lines and self.line_ranges is not None:
+            raise ValueError('changed-lines and line-ranges are mutually exclusive')
+        if self.timings_json:
+            object.__setattr__(self, 'timings', True)
+        if self.timings and self.pipeline:
+            raise ValueError('timings cannot be combined with pipeline')
+        if self.jobs is None:
+            object.__setattr__(self, 'jobs', os.cpu_count() or 1)
 
 
 class Config(_Config):
-    def __init__(self, cli_settings):
+    def __init__(
+        self,
+        cli_settings,
+        path: t.Optional[Path] = None,
+        _found: t.Optional[t.Tuple[Path, t.Dict[str, t.Any]]] = None,
+    ):
         self._excludes: t.Optional[t.FrozenSet[str]] = None
-        project_root, config_settings = _find_config(Path(os.getcwd()))
+        self._exclude_matcher: t.Optional[_ExcludeMatcher] = None
+        self._cli_settings = cli_settings
+        self._resolver: t.Optional[_ConfigResolver] = None
+        if _found is None:
+            # if there is nothing to find for `path` (e.g. --stdin-filename),
+            # use the same project root as when walking the current directory
+            found = _ConfigFinder().find(path) if path is not None else None
+            _found = found or _find_config(Path(os.getcwd()))
+        project_root, config_settings = _found
         settings = {**config_settings, **cli_settings}
         super().__init__(**settings, project_root=project_root)
 
+    def __getstate__(self):
+        # configs are sent to worker processes, which never need these
+        state = self.__dict__.copy()
+        state['_exclude_matcher'] = None
+        state['_resolver'] = None
+        return state
+
+    def for_directory(self, directory: Path) -> 'Config':
+        """Get the config for the files inside `directory`.
+
+        This uses the nearest config file of that directory, falling back
+        to this config if there is none. Lookups are memoized, so this is
+        cheap to call for every file.
+        """
+        if self._resolver is None:
+            self._resolver = _ConfigResolver(self)
+        return self._resolver.resolve(directory)
+
     @property
     def excludes(self) -> t.FrozenSet[str]:
         if self._excludes is not None:
@@ -104,33 +164,126 @@ class Config(_Config):
         return self._excludes
 
     def is_path_excluded(self, path: Path):
-        # based on matches_filename from flake8 (MIT-licensed)
-        patterns = self.excludes
-        if not patterns:
+        if self._exclude_matcher is None:
+            self._exclude_matcher = _ExcludeMatcher(self.excludes, self.project_root)
+        return self._exclude_matcher.matches(path)
+
+    def is_path_or_parent_excluded(self, path: Path):
+        # like when walking the project, only the directories inside the project
+        # root are checked, no matter where the project itself is located
+        path = path.absolute()
+        root = Path(self.project_root).absolute()
+        try:
+            parts = path.relative_to(root).parts
+        except ValueError:
+            return self.is_path_excluded(path)
+        candidate = root
+        if self.is_path_excluded(candidate):
+            return True
+        for part in parts:
+            candidate /= part
+            if self.is_path_excluded(candidate):
+                return True
+        return False
+
+
+class _ExcludeMatcher:
+    # based on matches_filename from flake8 (MIT-licensed), but instead of
+    # calling fnmatch for each pattern all patterns are combined in a single
+    # regex, so checking a path takes at most three regex matches
+
+    def __init__(self, patterns: t.Iterable[str], project_root: Path):
+        patterns = sorted(patterns)
+        self._empty = not patterns
+        self._match_path = _compile_patterns(patterns)
+        # a basename can never match a pattern containing a path separator
+        seps = {os.sep, os.altsep} - {None}
+        self._match_basename = _compile_patterns(
+            p for p in patterns if not any(sep in p for sep in seps)
+        )
+        self._root = None
+        self._root_prefix = None
+        if project_root is not None and Path(project_root).is_absolute():
+            self._root = os.path.normcase(str(Path(project_root)))
+            self._root_prefix = self._root.rstrip(os.sep) + os.sep
+
+    def matches(self, path: Path) -> bool:
+        if self._empty:
             return False
         basename = path.name
-        if basename not in ('.', '..') and any(fnmatch(basename, p) for p in patterns):
+        if basename not in ('.', '..') and self._match_basename(
+            os.path.normcase(basename)
+        ):
             return True
-        absolute_path = path.absolute()
-        try:
-            relative_path = absolute_path.relative_to(self.project_root)
-        except ValueError:
+        absolute_path = os.path.normcase(str(path.absolute()))
+        if absolute_path == self._root:
+            relative_path = '.'
+        elif self._root_prefix and absolute_path.startswith(self._root_prefix):
+            relative_path = absolute_path[len(self._root_prefix) :]
+        else:
             # no relative path matching outside the project root
+            relative_path = None
+        if relative_path is not None and self._match_path(relative_path):
+            return True
+        return self._match_path(absolute_path) is not None
+
+
+def _compile_patterns(patterns: t.Iterable[str]) -> t.Callable[[str], t.Any]:
+    regex = '|'.join(translate(os.path.normcase(p)) for p in patterns)
+    # an empty alternation would match everything
+    return re.compile(regex or '(?!)').match
+
+
+class _ConfigResolver:
+    # maps directories to the config of their nearest config file; there is
+    # one config object per project root, so e.g. the compiled excludes are
+    # shared by all directories of a project
+
+    def __init__(self, default: Config):
+        self._default = default
+        self._finder = _ConfigFinder()
+        self._by_directory: t.Dict[Path, Config] = {}
+        self._by_root: t.Dict[Path, Config] = {Path(default.project_root): default}
+
+    def resolve(self, directory: Path) -> Config:
+        try:
+            return self._by_directory[directory]
+        except KeyError:
             pass
+        found = self._finder.find(directory)
+        if found is None:
+            config = self._default
         else:
-            if any(fnmatch(relative_path, p) for p in patterns):
-                return True
-        return any(fnmatch(absolute_path, p) for p in patterns)
+            root = found[0]
+            config = self._by_root.get(root)
+            if config is None:
+                config = Config(self._default._cli_settings, _found=found)
+                config._resolver = self
+                self._by_root[root] = config
+        self._by_directory[directory] = config
+        return config
 
 
-def _find_config(path: Path):
-    # taken from isort (MIT-licensed)
-    current_directory = path.absolute()
-    tries = 0
-    potential_root = None
-    while current_directory and tries < MAX_CONFIG_SEARCH_DEPTH:
+class _ConfigFinder:
+    # the search logic of _find_config, but every directory is only checked
+    # (and its config files parsed) once, no matter how many lookups pass it
+
+    def __init__(self):
+        self._directories: t.Dict[Path, t.Tuple[t.Dict[str, t.Any], bool, bool]] = {}
+
+    def _check_directory(
+        self, directory: Path
+    ) -> t.Tuple[t.Dict[str, t.Any], bool, bool]:
+        # returns the settings found in the directory, whether it contains any
+        # (possibly empty) config file, and whether the search stops there
+        try:
+            return self._directories[directory]
+        except KeyError:
+            pass
+        config_data = {}
+        has_config_file = False
         for config_file_name in CONFIG_SOURCES:
-            potential_config_file = current_directory / config_file_name
+            potential_config_file = directory / config_file_name
             if potential_config_file.is_file():
                 try:
                     config_data = _get_config_data(
@@ -140,22 +293,46 @@ def _find_config(path: Path):
                     warn(f'Could not load {potential_config_file}: {exc}')
                     config_data = {}
                 else:
-                    potential_root = current_directory
+                    has_config_file = True
                     if config_data:
-                        return current_directory, config_data
+                        break
+        is_stop_dir = not config_data and any(
+            (directory / stop_dir).is_dir() for stop_dir in STOP_CONFIG_SEARCH_ON_DIRS
+        )
+        result = config_data, has_config_file, is_stop_dir
+        self._directories[directory] = result
+        return result
 
-        for stop_dir in STOP_CONFIG_SEARCH_ON_DIRS:
-            if (current_directory / stop_dir).is_dir():
+    def find(self, path: Path) -> t.Optional[t.Tuple[Path, t.Dict[str, t.Any]]]:
+        # taken from isort (MIT-licensed)
+        current_directory = path.absolute()
+        tries = 0
+        potential_root = None
+        while current_directory and tries < MAX_CONFIG_SEARCH_DEPTH:
+            config_data, has_config_file, is_stop_dir = self._check_directory(
+                current_directory
+            )
+            if config_data:
+                return current_directory, config_data
+            elif has_config_file:
+                potential_root = current_directory
+            if is_stop_dir:
                 return current_directory, {}
 
-        new_directory = current_directory.parent
-        if new_directory == current_directory:
-            break
+            new_directory = current_directory.parent
+            if new_directory == current_directory:
+                break
+
+            current_directory = new_directory
+            tries += 1
 
-        current_directory = new_directory
-        tries += 1
+        if potential_root is None:
+            return None
+        return potential_root, {}
 
-    return (potential_root or path), {}
+
+def _find_config(path: Path):
+    return _ConfigFinder().find(path) or (path, {})
 
 
 def _get_config_data(file_path: Path, sections):
@@ -164,7 +341,9 @@ def _get_config_data(file_path: Path, sections):
 
     with file_path.open(encoding='utf-8') as config_file:
         if file_path.suffix == '.toml':
-            if toml is None:
+            try:
+                import toml
+            except ImportError:  # pragma: no cover
                 raise RuntimeError(
                     'To parse toml files, you need to `pip install toml`'
                 )
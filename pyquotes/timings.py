@@ -0,0 +1,158 @@
+import functools
+import math
+import time
+import typing as t
+from contextlib import contextmanager
+
+
+# the stages in the order they happen
+STAGES = (
+    'walk',
+    'exclude',
+    'read',
+    'decode',
+    'parse',
+    'scan',
+    'normalize',
+    'serialize',
+    'write',
+)
+
+# number of files listed in the summary
+SLOWEST_FILES = 10
+
+# time spent in each stage, or None if we are not recording
+_stages: t.Optional[t.Dict[str, float]] = None
+# time spent in nested stages of the stages currently being measured
+_nested: t.List[float] = []
+
+
+def start():
+    """Start recording the time spent in each stage."""
+    global _stages
+    _stages = {}
+    _nested.clear()
+
+
+def stop() -> t.Dict[str, float]:
+    """Stop recording and get the time spent in each stage.
+
+    The time of a stage does not include that of any stages measured
+    while it was running.
+    """
+    global _stages
+    stages, _stages = _stages, None
+    return stages or {}
+
+
+def _begin() -> float:
+    _nested.append(0)
+    return time.perf_counter()
+
+
+def _end(stage: str, start: float):
+    elapsed = time.perf_counter() - start
+    nested = _nested.pop()
+    _stages[stage] = _stages.get(stage, 0) + elapsed - nested
+    if _nested:
+        _nested[-1] += elapsed
+
+
+@contextmanager
+def measure(stage: str) -> t.Iterator[None]:
+    if _stages is None:
+        yield
+        return
+    start = _begin()
+    try:
+        yield
+    finally:
+        _end(stage, start)
+
+
+def timed(stage: str, func: t.Callable) -> t.Callable:
+    """Get a version of `func` whose calls are measured as `stage`.
+
+    This is meant for functions called very often, e.g. for each string;
+    when not recording, `func` itself is returned so there is no overhead.
+    """
+    if _stages is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = _begin()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _end(stage, start)
+
+    return wrapper
+
+
+def _percentile(values: t.List[float], percent: int) -> float:
+    # nearest-rank method; `values` must be sorted
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def get_report(
+    global_stages: t.Dict[str, float], file_stages: t.Dict[str, t.Dict[str, float]]
+) -> t.Dict[str, t.Any]:
+    """Get totals and percentiles of the recorded timings.
+
+    `global_stages` are the stages not specific to a file (such as walking
+    directories), `file_stages` those recorded while processing each file.
+    """
+    stages = {}
+    for stage in STAGES:
+        if stage in global_stages:
+            stages[stage] = {'total': global_stages[stage]}
+            continue
+        values = sorted(
+            times[stage] for times in file_stages.values() if stage in times
+        )
+        if not values:
+            continue
+        stages[stage] = {
+            'total': sum(values),
+            'p50': _percentile(values, 50),
+            'p90': _percentile(values, 90),
+            'p99': _percentile(values, 99),
+            'max': values[-1],
+        }
+    return {
+        'total': sum(data['total'] for data in stages.values()),
+        'stages': stages,
+        'files': {
+            name: {'total': sum(times.values()), **times}
+            for name, times in file_stages.items()
+        },
+    }
+
+
+def format_report(report: t.Dict[str, t.Any]) -> str:
+    """Format a report from :func:`get_report` for humans."""
+    lines = [
+        f'Timings for {len(report["files"])} file(s):',
+        f'  {"stage":<10} {"total":>9} {"share":>6} '
+        f'{"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}',
+    ]
+    total = report['total'] or 1
+    for stage, data in report['stages'].items():
+        line = f'  {stage:<10} {data["total"]:8.3f}s {data["total"] / total:6.1%}'
+        if 'p50' in data:
+            line += ''.join(
+                f' {data[key]:8.3f}s' for key in ('p50', 'p90', 'p99', 'max')
+            )
+        lines.append(line)
+    slowest = sorted(
+        report['files'].items(), key=lambda item: item[1]['total'], reverse=True
+    )[:SLOWEST_FILES]
+    if slowest:
+        lines.append('Slowest files:')
+    for name, times in slowest:
+        stages = ', '.join(
+            f'{stage} {times[stage]:.3f}s' for stage in STAGES if stage in times
+        )
+        lines.append(f'  {times["total"]:8.3f}s {name} ({stages})')
+    return '\n'.join(lines)
@@ -1,13 +1,34 @@
-import parso
-from parso.python.tree import DocstringMixin, PythonLeaf
-from parso.tree import BaseNode
+import collections
+import functools
+import itertools
+import os
+import typing as t
 
-from pyquotes.quotes import normalize_string_prefix, normalize_string_quotes
+from pyquotes import timings
+from pyquotes.quotes import may_change, normalize_string_prefix, normalize_string_quotes
 
 
-class _CombinedFString(PythonLeaf):
-    __slots__ = ()
-    type = 'combined_fstring'
+# parso is only imported once something actually needs to be parsed since
+# importing it takes a significant part of the startup time of the CLI
+
+
+@functools.lru_cache(maxsize=None)
+def _get_grammar():
+    import parso
+
+    # the same grammar `parso.parse` uses, without looking it up every time
+    return parso.load_grammar()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_combined_fstring_class():
+    from parso.python.tree import PythonLeaf
+
+    class _CombinedFString(PythonLeaf):
+        __slots__ = ()
+        type = 'combined_fstring'
+
+    return _CombinedFString
 
 
 def _replace_fstring(node):
@@ -16,25 +37,27 @@ def _replace_fstring(node):
     # we convert it back to a single string containing the full f-string
     prefix = node.children[0].prefix
     value = node.get_code(include_prefix=False)
-    return _CombinedFString(value, node.start_pos, prefix)
+    return _get_combined_fstring_class()(value, node.start_pos, prefix)
 
 
 def _iter_strings(tree):
+    from parso.python.tree import DocstringMixin
+    from parso.tree import BaseNode
+
     # note: this function mutates the tree while iterating it as it
-    # needs to replace f-string nodes
-    seen_string_nodes = set()
+    # needs to replace f-string nodes. strings are yielded in the order in
+    # which they appear in the source code.
+    doc_nodes = set()
 
     def scan(parent):
         if isinstance(parent, DocstringMixin):
             doc_node = parent.get_doc_node()
-            if doc_node is not None and doc_node not in seen_string_nodes:
-                seen_string_nodes.add(doc_node)
-                yield True, doc_node
+            if doc_node is not None:
+                doc_nodes.add(doc_node)
 
         for i, node in enumerate(parent.children):
-            if node.type == 'string' and node not in seen_string_nodes:
-                seen_string_nodes.add(node)
-                yield False, node
+            if node.type == 'string':
+                yield node in doc_nodes, node
             elif node.type == 'fstring':
                 parent.children[i] = node = _replace_fstring(node)
                 yield False, node
@@ -44,9 +67,564 @@ def _iter_strings(tree):
     return scan(tree)
 
 
-def transform_source(source: str, double_quotes: bool = False) -> str:
-    tree = parso.parse(source)
+ENGINES = ('tree', 'tokens')
+
+# inclusive (first, last) line numbers, starting at 1
+LineRanges = t.Sequence[t.Tuple[int, int]]
+
+
+class Edit(t.NamedTuple):
+    """The replacement of a string literal in the source code."""
+
+    #: offsets of the literal in the source code
+    start: int
+    end: int
+    old: str
+    new: str
+    #: position of the literal, with the line starting at 1 and the column at 0
+    line: int
+    column: int
+
+
+class _InvalidSource(Exception):
+    pass
+
+
+class _StringToken:
+    # stand-in for a parso leaf, which is all the normalization code needs
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _iter_source_parts(
+    lines: t.Iterable[str],
+) -> t.Iterator[t.Tuple[str, t.Any, t.Any]]:
+    # splits the code (given as lines, like `split_lines` in parso creates
+    # them) into consecutive `(text, is_doc, pos)` parts. `is_doc` is None
+    # for everything but the strings normalized when using the tree engine,
+    # with the same rules parso uses to detect docstrings (the first statement
+    # of a module/class/function if it is a plain string).
+    # the lines are consumed lazily, so this works with huge files as well
+    from parso.python.token import PythonTokenTypes
+    from parso.python.tokenize import tokenize_lines
+    from parso.utils import parse_version_string
+
+    _STRING = PythonTokenTypes.STRING
+    _FSTRING_START = PythonTokenTypes.FSTRING_START
+    _FSTRING_END = PythonTokenTypes.FSTRING_END
+    _FSTRING_STRING = PythonTokenTypes.FSTRING_STRING
+    _NEWLINE = PythonTokenTypes.NEWLINE
+    _INDENT = PythonTokenTypes.INDENT
+    _ENDMARKER = PythonTokenTypes.ENDMARKER
+    _NAME = PythonTokenTypes.NAME
+    _OP = PythonTokenTypes.OP
+    _ERRORS = (PythonTokenTypes.ERRORTOKEN, PythonTokenTypes.ERROR_DEDENT)
+
+    # number of open braces in each (nested) f-string we are in
+    fstring_braces = []
+    # the code of the (outermost) f-string we are in
+    fstring_parts = []
+    fstring_pos = None
+    prev_token = None
+    bracket_depth = 0
+    header_depth = None
+    doc_candidate = True
+    pending_doc = None
+    for token in tokenize_lines(lines, version_info=parse_version_string()):
+        type_ = token.type
+        if type_ in _ERRORS:
+            raise _InvalidSource
+        if pending_doc is not None:
+            text, pos = pending_doc
+            pending_doc = None
+            is_doc = type_ in (_NEWLINE, _ENDMARKER) or (
+                type_ == _OP and token.string == ';'
+            )
+            yield text, is_doc, pos
+        if fstring_braces:
+            # parso does not tokenize some f-strings properly; in that case
+            # its parser fails to build an f-string node from the tokens
+            if type_ == _FSTRING_START:
+                fstring_braces.append(0)
+            elif type_ == _FSTRING_STRING:
+                if prev_token.type == _OP and prev_token.string == '{':
+                    raise _InvalidSource
+            elif type_ == _OP and token.string == '{':
+                fstring_braces[-1] += 1
+            elif type_ == _OP and token.string == '}':
+                if not fstring_braces[-1]:
+                    raise _InvalidSource
+                fstring_braces[-1] -= 1
+            elif type_ == _FSTRING_END:
+                if fstring_braces.pop():
+                    raise _InvalidSource
+            fstring_parts += token.prefix, token.string
+            if not fstring_braces:
+                yield ''.join(fstring_parts), False, fstring_pos
+                fstring_parts = []
+            prev_token = token
+            continue
+        if token.prefix:
+            yield token.prefix, None, None
+        if doc_candidate and type_ in (_NEWLINE, _INDENT):
+            if token.string:
+                yield token.string, None, None
+            continue
+        was_doc_candidate = doc_candidate
+        doc_candidate = False
+        if type_ == _STRING:
+            if was_doc_candidate:
+                # only a docstring if nothing else follows it in the statement
+                pending_doc = token.string, token.start_pos
+            else:
+                yield token.string, False, token.start_pos
+        elif type_ == _FSTRING_START:
+            fstring_braces.append(0)
+            fstring_parts = [token.string]
+            fstring_pos = token.start_pos
+        else:
+            if token.string:
+                yield token.string, None, None
+            if type_ == _NAME and token.string in ('def', 'class'):
+                header_depth = bracket_depth
+            elif type_ == _OP:
+                if token.string in '([{':
+                    bracket_depth += 1
+                elif token.string in ')]}':
+                    bracket_depth = max(0, bracket_depth - 1)
+                elif token.string == ':' and bracket_depth == header_depth:
+                    header_depth = None
+                    doc_candidate = True
+        prev_token = token
+    if fstring_braces:  # pragma: no cover
+        raise _InvalidSource
+    if pending_doc is not None:  # pragma: no cover
+        yield pending_doc[0], True, pending_doc[1]
+
+
+def _iter_string_tokens(source):
+    # yields `(is_doc, pos, start, end)` for all strings that are normalized when
+    # using the tree engine
+    from parso.utils import split_lines
+
+    offset = 0
+    for text, is_doc, pos in _iter_source_parts(split_lines(source, keepends=True)):
+        if is_doc is not None:
+            yield is_doc, pos, offset, offset + len(text)
+        offset += len(text)
+
+
+def _in_line_ranges(line: int, line_ranges: t.Optional[LineRanges]) -> bool:
+    if line_ranges is None:
+        return True
+    return any(first <= line <= last for first, last in line_ranges)
+
+
+# the same literals (e.g. encodings or dict keys) show up again and again in a
+# project, so it pays off to remember how they are normalized
+@functools.lru_cache(maxsize=4096)
+def _normalize_string(value: str, is_doc: bool, double_quotes: bool) -> str:
+    leaf = _StringToken(value)
+    normalize_string_prefix(leaf)
+    normalize_string_quotes(leaf, is_doc, double_quotes=double_quotes)
+    return leaf.value
+
+
+def _iter_token_edits(
+    source: str, double_quotes: bool, line_ranges: t.Optional[LineRanges]
+) -> t.Iterator[Edit]:
+    # the edits are only yielded once the whole source has been tokenized, so
+    # we can still use the tree engine if the tokenizer finds broken code
+    edits = []
+    normalize = timings.timed('normalize', _normalize_string)
+    try:
+        for is_doc, (line, column), start, end in _iter_string_tokens(source):
+            if not _in_line_ranges(line, line_ranges):
+                continue
+            value = source[start:end]
+            new_value = normalize(value, is_doc, double_quotes)
+            if new_value != value:
+                edits.append(Edit(start, end, value, new_value, line, column))
+    except _InvalidSource:
+        # broken code is handled by the error recovery of parso's parser,
+        # which we cannot easily replicate here
+        return _iter_tree_edits(source, double_quotes, line_ranges)
+    return iter(edits)
+
+
+def _iter_transformed_parts(
+    lines: t.Iterable[str],
+    double_quotes: bool,
+    line_ranges: t.Optional[LineRanges] = None,
+) -> t.Iterator[t.Tuple[str, str]]:
+    # yields consecutive `(old, new)` parts of the code, which only differ for
+    # strings that were normalized. unlike everything else here this never
+    # needs the whole code in memory, but `_InvalidSource` may be raised at
+    # any point for code which only the tree engine can handle
+    normalize = timings.timed('normalize', _normalize_string)
+    for text, is_doc, pos in _iter_source_parts(lines):
+        if is_doc is None or not _in_line_ranges(pos[0], line_ranges):
+            yield text, text
+        else:
+            yield text, normalize(text, is_doc, double_quotes)
+
+
+def _tokens_need_changes(
+    lines: t.Iterable[str],
+    double_quotes: bool,
+    line_ranges: t.Optional[LineRanges] = None,
+) -> bool:
+    # nothing is normalized after the first literal that needs changes, but
+    # the rest of the code is still tokenized since the tree engine may not
+    # change that literal at all if the code turns out to be broken
+    normalize = timings.timed('normalize', _normalize_string)
+    changed = False
+    for text, is_doc, pos in _iter_source_parts(lines):
+        if (
+            not changed
+            and is_doc is not None
+            and _in_line_ranges(pos[0], line_ranges)
+            and normalize(text, is_doc, double_quotes) != text
+        ):
+            changed = True
+    return changed
+
+
+def _iter_tree_edits(
+    source: str, double_quotes: bool, line_ranges: t.Optional[LineRanges] = None
+) -> t.Iterator[Edit]:
+    from parso.utils import split_lines
+
+    with timings.measure('parse'):
+        tree = _get_grammar().parse(source)
+    line_offsets = None
+    normalize = timings.timed('normalize', _normalize_string)
     for is_doc, leaf in _iter_strings(tree):
-        normalize_string_prefix(leaf)
-        normalize_string_quotes(leaf, is_doc, double_quotes=double_quotes)
-    return tree.get_code()
+        line, column = leaf.start_pos
+        if not _in_line_ranges(line, line_ranges):
+            continue
+        value = leaf.value
+        new_value = normalize(value, is_doc, double_quotes)
+        if new_value == value:
+            continue
+        if line_offsets is None:
+            line_offsets = [0]
+            for source_line in split_lines(source, keepends=True):
+                line_offsets.append(line_offsets[-1] + len(source_line))
+        start = line_offsets[line - 1] + column
+        yield Edit(start, start + len(value), value, new_value, line, column)
+
+
+def _transform_tree(
+    source: str, double_quotes: bool, line_ranges: t.Optional[LineRanges] = None
+) -> str:
+    return apply_edits(source, _iter_tree_edits(source, double_quotes, line_ranges))
+
+
+def iter_edits(
+    source: str,
+    double_quotes: bool = False,
+    engine: str = 'tree',
+    line_ranges: t.Optional[LineRanges] = None,
+) -> t.Iterator[Edit]:
+    """Get the edits needed to normalize the string literals in `source`.
+
+    Each changed literal results in one :class:`Edit`; they are ordered by
+    their position in the source code and never overlap. When using the
+    tree engine the edits are produced lazily, so e.g. checking whether a
+    file needs changes can stop at the first one.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'unknown engine: {engine}')
+    if line_ranges is not None and not line_ranges:
+        return iter(())
+    if not may_change(source, double_quotes):
+        return iter(())
+    if engine == 'tree':
+        return _iter_tree_edits(source, double_quotes, line_ranges)
+    else:
+        return _iter_token_edits(source, double_quotes, line_ranges)
+
+
+def needs_changes(
+    source: str,
+    double_quotes: bool = False,
+    engine: str = 'tree',
+    line_ranges: t.Optional[LineRanges] = None,
+) -> bool:
+    """Check whether any string literals in `source` need to be normalized.
+
+    This stops at the first literal that needs changes and never computes
+    the edits, so it is faster than :func:`iter_edits` for code which is
+    not normalized yet.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'unknown engine: {engine}')
+    if line_ranges is not None and not line_ranges:
+        return False
+    if not may_change(source, double_quotes):
+        return False
+    if engine == 'tokens':
+        from parso.utils import split_lines
+
+        lines = split_lines(source, keepends=True)
+        try:
+            return _tokens_need_changes(lines, double_quotes, line_ranges)
+        except _InvalidSource:
+            pass
+    return next(_iter_tree_edits(source, double_quotes, line_ranges), None) is not None
+
+
+def apply_edits(source: str, edits: t.Iterable[Edit]) -> str:
+    """Apply edits from :func:`iter_edits` to the source code."""
+    parts = []
+    pos = 0
+    for edit in edits:
+        parts.append(source[pos : edit.start])
+        parts.append(edit.new)
+        pos = edit.end
+    if not parts:
+        return source
+    parts.append(source[pos:])
+    return ''.join(parts)
+
+
+def transform_source(
+    source: str,
+    double_quotes: bool = False,
+    engine: str = 'tree',
+    line_ranges: t.Optional[LineRanges] = None,
+) -> str:
+    return apply_edits(source, iter_edits(source, double_quotes, engine, line_ranges))
+
+
+_Key = t.TypeVar('_Key')
+
+# number of sources sent to a worker process at once
+_BATCH_SIZE = 32
+
+
+def _transform_batch(
+    sources: t.Sequence[str], double_quotes: bool, engine: str
+) -> t.List[str]:
+    return [transform_source(source, double_quotes, engine) for source in sources]
+
+
+def transform_many(
+    sources: t.Iterable[t.Tuple[_Key, str]],
+    double_quotes: bool = False,
+    engine: str = 'tree',
+    jobs: t.Optional[int] = 1,
+) -> t.Iterator[t.Tuple[_Key, str]]:
+    """Normalize the string literals in many sources.
+
+    `sources` are ``(key, source)`` pairs, for which ``(key, result)`` pairs
+    are produced lazily in the same order, with `result` being the same as
+    that of :func:`transform_source`. With `jobs` other than 1, the sources
+    are transformed by that many processes (or one per CPU if it is None);
+    they only get read from `sources` as the results are consumed.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'unknown engine: {engine}')
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs == 1:
+        return (
+            (key, transform_source(source, double_quotes, engine))
+            for key, source in sources
+        )
+    return _transform_parallel(iter(sources), double_quotes, engine, jobs)
+
+
+def _transform_parallel(sources, double_quotes, engine, jobs):
+    from concurrent.futures import ProcessPoolExecutor
+
+    pending = collections.deque()
+
+    def _submit():
+        batch = list(itertools.islice(sources, _BATCH_SIZE))
+        if not batch:
+            return False
+        keys, batch_sources = zip(*batch)
+        future = executor.submit(_transform_batch, batch_sources, double_quotes, engine)
+        pending.append((keys, future))
+        return True
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        try:
+            # keep a few batches per worker queued so they never have to wait
+            while len(pending) < 2 * jobs and _submit():
+                pass
+            while pending:
+                keys, future = pending.popleft()
+                results = future.result()
+                _submit()
+                yield from zip(keys, results)
+        finally:
+            for __, future in pending:
+                future.cancel()
+
+
+def _get_body(node):
+    # the body of a function or class which is parsed separately by parso's
+    # diff parser, or None. this follows `_func_or_class_has_suite` in parso
+    if node.type == 'decorated':
+        node = node.children[-1]
+    if node.type in ('async_funcdef', 'async_stmt'):
+        node = node.children[-1]
+    if node.type in ('classdef', 'funcdef') and node.children[-1].type == 'suite':
+        return node.children[-1]
+    return None
+
+
+def _get_doc_candidate(node):
+    # the string which is a docstring if `node` is the first statement of a
+    # module, class or function; see `DocstringMixin.get_doc_node` in parso
+    if node.type == 'simple_stmt':
+        node = node.children[0]
+    return node if node.type == 'string' else None
+
+
+def _scan_strings(children, strings, doc_nodes):
+    # like `_iter_strings`, but without replacing the f-string nodes as the
+    # tree is kept for parsing the next version of a `Document`
+    from parso.tree import BaseNode
+
+    for node in children:
+        if node.type == 'string':
+            strings.append((node, node.value, node in doc_nodes))
+        elif node.type == 'fstring':
+            strings.append((node, node.get_code(include_prefix=False), False))
+        elif isinstance(node, BaseNode):
+            if node.type in ('funcdef', 'classdef'):
+                doc_node = node.get_doc_node()
+                if doc_node is not None:
+                    doc_nodes.add(doc_node)
+            _scan_strings(node.children, strings, doc_nodes)
+
+
+class Document:
+    """A source file which is normalized repeatedly while it is being edited.
+
+    Updating the source only re-parses the changed parts using parso's diff
+    parser, and only the strings of statements which are new or changed
+    get normalized again, so e.g. formatting on every keystroke in an editor
+    does not get slower for large files.
+    """
+
+    def __init__(self, source: str = '', double_quotes: bool = False):
+        from parso.utils import split_lines
+
+        self.double_quotes = double_quotes
+        self.source = source
+        self._grammar = _get_grammar()
+        self._lines = split_lines(source, keepends=True)
+        with timings.measure('parse'):
+            self._module = self._grammar.parse(source)
+        self._strings = None
+        # the strings of each statement (and function or class signature) by
+        # the id of its node; parso reuses unchanged nodes when updating
+        self._statements = {}
+        self._normalized = {}
+
+    def update(self, source: str):
+        """Replace the source code with a new version of it."""
+        from parso.utils import split_lines
+
+        if source == self.source:
+            return
+        lines = split_lines(source, keepends=True)
+        with timings.measure('parse'):
+            try:
+                # the diff parser is not part of the public API of parso, so
+                # anything about it may change with newer versions
+                from parso.python.diff import DiffParser
+
+                parser = DiffParser(
+                    self._grammar._pgen_grammar, self._grammar._tokenizer, self._module
+                )
+                self._module = parser.update(old_lines=self._lines, new_lines=lines)
+            except Exception:
+                # the diff parser gives up on some edits (and it changes the
+                # tree while parsing), so parse everything from scratch
+                self._module = self._grammar.parse(source)
+                self._statements = {}
+        self.source = source
+        self._lines = lines
+        self._strings = None
+
+    def iter_edits(
+        self, line_ranges: t.Optional[LineRanges] = None
+    ) -> t.Iterator[Edit]:
+        """Get the edits needed to normalize the string literals.
+
+        The edits are the same as those from :func:`iter_edits` for the
+        current source code.
+        """
+        if self._strings is None:
+            self._strings = self._get_strings()
+        if line_ranges is not None and not line_ranges:
+            return
+        normalized, self._normalized = self._normalized, {}
+        normalize = timings.timed('normalize', _normalize_string)
+        line_offsets = None
+        for node, value, is_doc in self._strings:
+            key = value, is_doc
+            new_value = normalized.get(key)
+            if new_value is None:
+                new_value = normalize(value, is_doc, self.double_quotes)
+            self._normalized[key] = new_value
+            if new_value == value:
+                continue
+            line, column = node.start_pos
+            if not _in_line_ranges(line, line_ranges):
+                continue
+            if line_offsets is None:
+                line_offsets = [0, *itertools.accumulate(map(len, self._lines))]
+            start = line_offsets[line - 1] + column
+            yield Edit(start, start + len(value), value, new_value, line, column)
+
+    def transform(self, line_ranges: t.Optional[LineRanges] = None) -> str:
+        """Get the normalized source code, like :func:`transform_source`."""
+        return apply_edits(self.source, self.iter_edits(line_ranges))
+
+    def _get_strings(self):
+        statements, self._statements = self._statements, {}
+        strings = []
+
+        def scan_body(children, doc_index):
+            for i, node in enumerate(children):
+                entry = statements.get(id(node))
+                if entry is None or entry[0] is not node:
+                    entry = node, self._scan_statement(node)
+                self._statements[id(node)] = entry
+                doc_node = _get_doc_candidate(node) if i == doc_index else None
+                for string in entry[1]:
+                    if string[0] is doc_node:
+                        string = doc_node, string[1], True
+                    strings.append(string)
+                body = _get_body(node)
+                if body is not None:
+                    # the first statement after the newline is the docstring
+                    scan_body(body.children, 1)
+
+        with timings.measure('scan'):
+            scan_body(self._module.children, 0)
+        return strings
+
+    @staticmethod
+    def _scan_statement(node):
+        # the strings of a statement, or of the signature of a function or
+        # class as its body is handled separately; their nodes are kept
+        # when only the body changes
+        strings = []
+        body = _get_body(node)
+        if body is None:
+            _scan_strings([node], strings, set())
+        else:
+            while node is not body:
+                _scan_strings(node.children[:-1], strings, set())
+                node = node.children[-1]
+        return strings
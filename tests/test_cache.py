@@ -0,0 +1,120 @@
+import os
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from pyquotes.cache import CACHE_DIR_NAME, Cache
+from pyquotes.cli import main
+
+
+@pytest.fixture
+def cli_runner():
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        Path('.git').mkdir()
+        Path('clean.py').write_text("x = 'hello'  # \"clean\"\n")
+        Path('dirty.py').write_text('x = "hello"\n')
+        yield runner
+
+
+def _fail(*a, **kw):
+    raise Exception('file should have been skipped')
+
+
+def test_cache_roundtrip(tmpdir):
+    tmpdir = Path(tmpdir)
+    file = tmpdir / 'test.py'
+    file.write_text('')
+    cache = Cache.load(tmpdir, False)
+    assert not cache.is_clean(file)
+    cache.mark_clean(file, (file.stat().st_mtime, 0))
+    cache.write()
+    assert Cache.load(tmpdir, False).is_clean(file)
+    assert not Cache.load(tmpdir, True).is_clean(file)
+    file.write_text('x')
+    assert not Cache.load(tmpdir, False).is_clean(file)
+
+
+def test_cache_merge(tmpdir):
+    tmpdir = Path(tmpdir)
+    a = tmpdir / 'a.py'
+    b = tmpdir / 'b.py'
+    a.touch()
+    b.touch()
+    cache1 = Cache.load(tmpdir, False)
+    cache2 = Cache.load(tmpdir, False)
+    cache1.mark_clean(a, (a.stat().st_mtime, 0))
+    cache2.mark_clean(b, (b.stat().st_mtime, 0))
+    cache1.write()
+    cache2.write()
+    cache = Cache.load(tmpdir, False)
+    assert cache.is_clean(a)
+    assert cache.is_clean(b)
+
+
+def test_cache_corrupt(tmpdir):
+    tmpdir = Path(tmpdir)
+    cache = Cache.load(tmpdir, False)
+    cache.path.parent.mkdir()
+    cache.path.write_text('garbage')
+    assert not Cache.load(tmpdir, False).is_clean(tmpdir / 'test.py')
+
+
+def test_cli_skips_clean(cli_runner, monkeypatch):
+    result = cli_runner.invoke(main, ['--check', '.'], prog_name='pyquotes')
+    assert result.exit_code == 1
+    assert Path(CACHE_DIR_NAME).is_dir()
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    result = cli_runner.invoke(main, ['--verbose', 'clean.py'], prog_name='pyquotes')
+    assert result.exit_code == 0
+    assert result.stderr.strip() == 'clean.py is up to date'
+
+
+def test_cli_updated_files_are_cached(cli_runner, monkeypatch):
+    result = cli_runner.invoke(main, ['.'], prog_name='pyquotes')
+    assert result.exit_code == 1
+    assert result.stderr.strip() == 'Updated dirty.py'
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    result = cli_runner.invoke(main, ['.'], prog_name='pyquotes')
+    assert result.exit_code == 0
+
+
+def test_cli_modified_file(cli_runner):
+    result = cli_runner.invoke(main, ['.'], prog_name='pyquotes')
+    assert result.exit_code == 1
+    Path('clean.py').write_text('x = "hello world"\n')
+    os.utime('clean.py', (0, 0))
+    result = cli_runner.invoke(main, ['.'], prog_name='pyquotes')
+    assert result.exit_code == 1
+    assert result.stderr.strip() == 'Updated clean.py'
+
+
+def test_cli_no_cache(cli_runner, monkeypatch):
+    result = cli_runner.invoke(main, ['--check', '.'], prog_name='pyquotes')
+    assert result.exit_code == 1
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    result = cli_runner.invoke(main, ['--no-cache', 'clean.py'], prog_name='pyquotes')
+    assert result.exit_code != 0
+    assert result.stderr.strip() == 'Error while processing clean.py'
+
+
+def test_cli_clear_cache(cli_runner):
+    result = cli_runner.invoke(main, ['--check', '.'], prog_name='pyquotes')
+    assert Path(CACHE_DIR_NAME).is_dir()
+    result = cli_runner.invoke(main, ['--clear-cache'], prog_name='pyquotes')
+    assert result.exit_code == 0
+    assert not Path(CACHE_DIR_NAME).exists()
+
+
+def test_cli_clear_cache_nested(cli_runner):
+    Path('sub').mkdir()
+    Path('sub/setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    Path('sub/clean.py').write_text('x = "hello"\n')
+    cli_runner.invoke(main, ['--check', '.'], prog_name='pyquotes')
+    assert Path(CACHE_DIR_NAME).is_dir()
+    assert Path('sub', CACHE_DIR_NAME).is_dir()
+    result = cli_runner.invoke(main, ['--clear-cache'], prog_name='pyquotes')
+    assert result.exit_code == 0
+    assert not Path(CACHE_DIR_NAME).exists()
+    assert not Path('sub', CACHE_DIR_NAME).exists()
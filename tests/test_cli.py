@@ -1,4 +1,9 @@
+import json
+import os
+import pstats
 import shutil
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
@@ -6,6 +11,7 @@ from click.testing import CliRunner
 
 import pyquotes
 from pyquotes.cli import main
+from pyquotes.encoding import decode_source
 from pyquotes.transform import transform_source
 
 
@@ -55,6 +61,7 @@ def test_check_only_verbose(cli_runner):
     _assert_unchanged('nested/weird.py')
     assert result.exit_code == 1
     assert sorted(result.stderr.strip().splitlines()) == [
+        '1 file(s) did not need to be parsed',
         'code/a.py is up to date',
         'code/build is excluded',
         'code/nested/b.py needs changes',
@@ -95,6 +102,38 @@ def test_check_only_uptodate(cli_runner):
     assert not result.output
 
 
+@pytest.mark.parametrize('args', ([], ['--jobs=2'], ['--pipeline']))
+def test_check_only_fail_fast(cli_runner, args):
+    result = cli_runner.invoke(
+        main, ['--check-only', '--fail-fast', *args, 'code'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    assert result.stderr.strip() == 'code/nested/b.py needs changes'
+    assert not result.output
+
+
+@pytest.mark.parametrize('arg', ('--diff', '--patch'))
+def test_fail_fast(cli_runner, arg):
+    result = cli_runner.invoke(
+        main, ['--fail-fast', '--jobs=4', arg, 'code'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    assert result.output.count('+++') == 1
+    _assert_unchanged('nested/b.py')
+    _assert_unchanged('nested/weird.py')
+
+
+def test_fail_fast_update(cli_runner):
+    # files which are already being written in parallel could not be reported
+    result = cli_runner.invoke(
+        main, ['--fail-fast', '--jobs=4', 'code'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 2
+    assert 'fail-fast requires check-only, diff or patch' in result.stderr
+    _assert_unchanged('nested/b.py')
+    _assert_unchanged('nested/weird.py')
+
+
 def test_diff(cli_runner, monkeypatch):
     monkeypatch.setattr('pyquotes.cli._getmtime', lambda x: '<time is meaningless>')
     result = cli_runner.invoke(
@@ -113,6 +152,28 @@ def test_diff(cli_runner, monkeypatch):
     ]
 
 
+def test_patch(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--patch', '-X', 'weird.py', 'code'], prog_name='pyquotes'
+    )
+    _assert_unchanged('a.py')
+    _assert_unchanged('nested/b.py')
+    assert result.exit_code == 1
+    assert result.stderr == ''
+    assert result.output.splitlines() == [
+        'diff --git a/code/nested/b.py b/code/nested/b.py',
+        '--- a/code/nested/b.py',
+        '+++ b/code/nested/b.py',
+        '@@ -1 +1 @@',
+        '-hello = "world"',
+        "+hello = 'world'",
+    ]
+    subprocess.run(['git', 'init', '-q'], check=True)
+    subprocess.run(['git', 'apply', '-'], input=result.stdout_bytes, check=True)
+    _assert_unchanged('a.py')
+    _assert_changed('nested/b.py')
+
+
 def test_update(cli_runner):
     result = cli_runner.invoke(main, ['code'], prog_name='pyquotes')
     _assert_unchanged('a.py')
@@ -126,6 +187,74 @@ def test_update(cli_runner):
     assert result.output == ''
 
 
+@pytest.mark.parametrize(
+    ('durability', 'syncs'),
+    (
+        ('none', 0),
+        # each file and its directory
+        ('file', 4),
+        # both files and their common directory
+        ('batch', 3),
+    ),
+)
+@pytest.mark.parametrize('args', ([], ['--stream-threshold', '1'], ['--pipeline']))
+def test_update_durability(cli_runner, monkeypatch, durability, syncs, args):
+    fsync = os.fsync
+    synced = []
+    monkeypatch.setattr(os, 'fsync', lambda fd: synced.append(fd) or fsync(fd))
+    result = cli_runner.invoke(
+        main, ['--jobs=1', f'--durability={durability}', *args, 'code']
+    )
+    assert result.exit_code == 1
+    _assert_changed('nested/b.py')
+    _assert_changed('nested/weird.py')
+    assert len(synced) == syncs
+    assert not list(Path('code').glob('**/*.pyquoted'))
+
+
+@pytest.mark.parametrize('args', ([], ['--stream-threshold', '1']))
+def test_update_preserve_mtime(cli_runner, args):
+    path = Path('code/nested/b.py')
+    os.utime(path, (1234567890, 1234567890))
+    path.chmod(0o640)
+    result = cli_runner.invoke(main, ['--preserve-mtime', *args, str(path)])
+    assert result.exit_code == 1
+    _assert_changed('nested/b.py')
+    assert path.stat().st_mtime == 1234567890
+    assert path.stat().st_mode & 0o777 == 0o640
+    # the cache still knows that the file is up to date now
+    result = cli_runner.invoke(main, ['--check', '--verbose', str(path)])
+    assert result.exit_code == 0
+    assert result.stderr == 'code/nested/b.py is up to date\n'
+
+
+@pytest.mark.parametrize('mode', (0o755, 0o600, 0o444))
+def test_update_mode(cli_runner, mode):
+    path = Path('code/nested/b.py')
+    path.chmod(mode)
+    old_umask = os.umask(0o077)
+    try:
+        result = cli_runner.invoke(main, [str(path)])
+    finally:
+        os.umask(old_umask)
+    assert result.exit_code == 1
+    _assert_changed('nested/b.py')
+    assert path.stat().st_mode & 0o777 == mode
+
+
+def test_update_temp_file_exists(cli_runner, monkeypatch):
+    names = iter((b'\x00' * 4, b'\x00' * 4, b'\x01' * 4))
+    monkeypatch.setattr(os, 'urandom', lambda n: next(names))
+    # e.g. left behind by a concurrent run
+    tmp_file = Path('code/nested/b.py.00000000.pyquoted')
+    tmp_file.write_text('foo')
+    result = cli_runner.invoke(main, ['code/nested/b.py'])
+    assert result.exit_code == 1
+    _assert_changed('nested/b.py')
+    assert tmp_file.read_text() == 'foo'
+    assert list(Path('code').glob('**/*.pyquoted')) == [tmp_file]
+
+
 def test_update_file(cli_runner):
     result = cli_runner.invoke(main, ['code/build/nope.py'], prog_name='pyquotes')
     _assert_changed('build/nope.py')
@@ -147,13 +276,118 @@ def test_error(cli_runner, monkeypatch):
     def _fail(*a, **kw):
         raise Exception('kaboom')
 
-    monkeypatch.setattr('pyquotes.cli.transform_source', _fail)
-    result = cli_runner.invoke(main, ['code/a.py'], prog_name='pyquotes')
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    result = cli_runner.invoke(main, ['code/nested/b.py'], prog_name='pyquotes')
     assert result.exit_code != 0
-    assert result.stderr.strip() == 'Error while processing code/a.py'
+    assert result.stderr.strip() == 'Error while processing code/nested/b.py'
     assert result.output == ''
 
 
+@pytest.mark.parametrize(
+    'args', (['--jobs=1'], ['--jobs=2'], ['--pipeline', '--jobs=2'])
+)
+def test_error_early(cli_runner, args):
+    root = Path('many')
+    root.mkdir()
+    (root / 'f00.py').write_bytes(b'x = "\xff"\n')
+    for i in range(1, 20):
+        (root / f'f{i:02}.py').write_text('x = "a"\n')
+    result = cli_runner.invoke(main, [*args, 'many'], prog_name='pyquotes')
+    assert isinstance(result.exception, UnicodeDecodeError)
+    lines = result.stderr.splitlines()
+    assert lines[0] == 'Error while processing many/f00.py'
+    # files updated by workers before we stopped are still reported
+    updated = sorted(
+        f'Updated {path}'
+        for path in root.iterdir()
+        if path.read_bytes() == b"x = 'a'\n"
+    )
+    assert lines[1:] == updated
+    if '--pipeline' not in args:
+        assert len(updated) <= 4
+    if args == ['--jobs=1']:
+        assert not updated
+
+
+def _get_records(output):
+    return [json.loads(line) for line in output.splitlines()]
+
+
+@pytest.mark.parametrize('check_only', (False, True))
+def test_ndjson(cli_runner, check_only):
+    args = ['--format', 'ndjson', '-X', 'weird.py', 'code']
+    if check_only:
+        args.insert(0, '--check')
+    result = cli_runner.invoke(main, args, prog_name='pyquotes')
+    assert result.exit_code == 1
+    assert result.stderr == ''
+    records = _get_records(result.output)
+    for record in records:
+        if record.get('status') != 'excluded':
+            assert record.pop('duration') >= 0
+    # excluded files are found while walking the directories, i.e. before
+    # processing any files
+    assert records == [
+        {'type': 'file', 'path': 'code/build', 'status': 'excluded'},
+        {'type': 'file', 'path': 'code/nested/weird.py', 'status': 'excluded'},
+        {'type': 'file', 'path': 'code/a.py', 'status': 'unchanged', 'changes': 0},
+        {
+            'type': 'file',
+            'path': 'code/nested/b.py',
+            'status': 'changed',
+            'changes': None if check_only else 1,
+        },
+        {
+            'type': 'summary',
+            'files': 2,
+            'changed': 1,
+            'unchanged': 1,
+            'excluded': 2,
+            'error': 0,
+        },
+    ]
+
+
+def test_ndjson_error(cli_runner, monkeypatch):
+    def _fail(source, *a, **kw):
+        if 'world' in source:
+            raise Exception('kaboom')
+        return iter(())
+
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    result = cli_runner.invoke(
+        main,
+        ['--format', 'ndjson', '--jobs=1', 'code/nested/b.py', 'code/a.py'],
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    records = _get_records(result.output)
+    assert records[0] == {
+        'type': 'file',
+        'path': 'code/nested/b.py',
+        'status': 'error',
+        'error': 'Exception: kaboom',
+    }
+    assert records[1]['status'] == 'unchanged'
+    assert records[2]['error'] == 1
+
+
+@pytest.mark.parametrize(
+    ('args', 'error'),
+    (
+        (['--diff', 'code'], 'cannot be combined with diff or patch'),
+        (['--patch', 'code'], 'cannot be combined with diff or patch'),
+        (['-'], 'ndjson format cannot be used with "-"'),
+    ),
+)
+def test_ndjson_invalid(cli_runner, args, error):
+    result = cli_runner.invoke(
+        main, ['--format', 'ndjson', *args], prog_name='pyquotes'
+    )
+    assert result.exit_code == 2
+    assert error in result.stderr
+
+
 def test_excludes(cli_runner):
     result = cli_runner.invoke(
         main,
@@ -162,6 +396,7 @@ def test_excludes(cli_runner):
     )
     assert result.exit_code == 1
     assert sorted(result.stderr.strip().splitlines()) == [
+        '1 file(s) did not need to be parsed',
         'code/a.py is up to date',
         'code/build/nope.py needs changes',
         'code/nested/b.py needs changes',
@@ -178,9 +413,501 @@ def test_extend_excludes(cli_runner):
     )
     assert result.exit_code == 1
     assert sorted(result.stderr.strip().splitlines()) == [
+        '1 file(s) did not need to be parsed',
         'code/a.py is up to date',
         'code/build is excluded',
         'code/nested/b.py needs changes',
         'code/nested/weird.py is excluded',
     ]
     assert not result.output
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_jobs(cli_runner, jobs):
+    result = cli_runner.invoke(
+        main,
+        ['--jobs', jobs, '--check-only', '--verbose', 'code'],
+        prog_name='pyquotes',
+    )
+    _assert_unchanged('nested/b.py')
+    assert result.exit_code == 1
+    # excludes are reported while collecting files, everything else is in
+    # path order regardless of the number of workers
+    assert result.stderr.strip().splitlines() == [
+        'code/build is excluded',
+        'code/a.py is up to date',
+        'code/nested/b.py needs changes',
+        'code/nested/weird.py needs changes',
+        '1 file(s) did not need to be parsed',
+    ]
+    assert not result.output
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_pipeline(cli_runner, jobs):
+    result = cli_runner.invoke(
+        main, ['--pipeline', '--jobs', jobs, '--verbose', 'code'], prog_name='pyquotes'
+    )
+    _assert_unchanged('a.py')
+    _assert_changed('nested/b.py')
+    _assert_changed('nested/weird.py')
+    assert result.exit_code == 1
+    # results are in path order, but directories are walked while processing
+    # so excludes may show up between them
+    lines = result.stderr.strip().splitlines()
+    lines.remove('code/build is excluded')
+    assert lines == [
+        'code/a.py is up to date',
+        'Updated code/nested/b.py',
+        'Updated code/nested/weird.py',
+        '1 file(s) did not need to be parsed',
+    ]
+    # everything is up to date and in the cache now
+    result = cli_runner.invoke(main, ['--pipeline', '--check', 'code'])
+    assert result.exit_code == 0
+
+
+def test_pipeline_py36(cli_runner, monkeypatch):
+    # the process pool cannot spawn its workers, so files are processed in a
+    # thread instead
+    monkeypatch.setattr('sys.version_info', (3, 6, 15, 'final', 0))
+    monkeypatch.setattr(
+        'concurrent.futures.ProcessPoolExecutor',
+        lambda *a, **kw: pytest.fail('process pool used'),
+    )
+    result = cli_runner.invoke(
+        main, ['--pipeline', '--jobs=2', 'code'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    _assert_changed('nested/b.py')
+    _assert_changed('nested/weird.py')
+
+
+def test_pipeline_error(cli_runner, monkeypatch):
+    def _fail(*a, **kw):
+        raise Exception('kaboom')
+
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    result = cli_runner.invoke(
+        main, ['--pipeline', '--jobs=1', 'code'], prog_name='pyquotes'
+    )
+    assert result.exit_code != 0
+    assert str(result.exception) == 'kaboom'
+    # files already being processed when the first one failed are reported too
+    lines = result.stderr.strip().splitlines()
+    assert lines[0] == 'Error while processing code/nested/b.py'
+    assert lines[1:] in ([], ['Error while processing code/nested/weird.py'])
+    _assert_unchanged('nested/b.py')
+    _assert_unchanged('nested/weird.py')
+
+
+def test_pipeline_timings(cli_runner):
+    result = cli_runner.invoke(main, ['--pipeline', '--timings', 'code'])
+    assert result.exit_code == 2
+    assert 'timings cannot be combined with pipeline' in result.stderr
+
+
+def test_duplicates(cli_runner):
+    os.symlink('nested', 'code/linked')
+    os.link('code/nested/b.py', 'code/hardlink.py')
+    os.symlink('../nested', 'code/nested/loop')
+    result = cli_runner.invoke(
+        main,
+        ['-j1', '--check-only', '--verbose', 'code/nested/b.py', 'code', 'code/a.py'],
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    assert result.stderr.strip().splitlines() == [
+        'code/build is excluded',
+        'code/linked/loop is a symlink loop',
+        'code/nested/b.py needs changes',
+        'code/a.py is up to date',
+        'code/linked/weird.py needs changes',
+        '1 file(s) did not need to be parsed',
+    ]
+
+
+def test_nested_config(cli_runner):
+    sub = Path('code/nested')
+    (sub / 'setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    (sub / 'gen').mkdir()
+    (sub / 'gen' / 'x.py').write_text("x = 'foo'\n")
+    (sub / 'sub').mkdir()
+    (sub / 'sub' / 'setup.cfg').write_text('[pyquotes]\nextend-exclude = gen\n')
+    (sub / 'sub' / 'gen').mkdir()
+    (sub / 'sub' / 'gen' / 'x.py').write_text("x = 'foo'\n")
+    (sub / 'sub' / 'y.py').write_text('y = "foo"\n')
+    result = cli_runner.invoke(main, ['-j1', '--verbose', 'code'], prog_name='pyquotes')
+    assert result.exit_code == 1
+    assert result.stderr.strip().splitlines() == [
+        'code/build is excluded',
+        'code/nested/sub/gen is excluded',
+        'code/a.py is up to date',
+        'code/nested/b.py is up to date',
+        'Updated code/nested/gen/x.py',
+        'Updated code/nested/sub/y.py',
+        'code/nested/weird.py is up to date',
+        '3 file(s) did not need to be parsed',
+    ]
+    _assert_unchanged('a.py')
+    _assert_unchanged('nested/b.py')
+    assert (sub / 'gen' / 'x.py').read_text() == 'x = "foo"\n'
+    assert (sub / 'sub' / 'gen' / 'x.py').read_text() == "x = 'foo'\n"
+    assert (sub / 'sub' / 'y.py').read_text() == "y = 'foo'\n"
+    result = cli_runner.invoke(main, ['-j1', 'code'], prog_name='pyquotes')
+    assert result.exit_code == 0
+
+
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+@pytest.mark.parametrize(
+    ('data', 'expected'),
+    (
+        (b'x = "y"\r\nz = "\xc3\xa4"\r\n', b"x = 'y'\r\nz = '\xc3\xa4'\r\n"),
+        (b'\xef\xbb\xbfx = "y"\n', b"\xef\xbb\xbfx = 'y'\n"),
+        (
+            b'# coding: latin-1\r\nx = "\xe4"\r\n',
+            b"# coding: latin-1\r\nx = '\xe4'\r\n",
+        ),
+    ),
+)
+def test_encoding_and_newlines(cli_runner, engine, data, expected):
+    path = Path('code/enc.py')
+    path.write_bytes(data)
+    result = cli_runner.invoke(main, ['--engine', engine, str(path)])
+    assert result.exit_code == 1
+    assert path.read_bytes() == expected
+    result = cli_runner.invoke(main, ['--engine', engine, '-'], input=data)
+    assert result.exit_code == 1
+    assert result.stdout_bytes == expected
+
+
+@pytest.mark.parametrize(
+    'data',
+    (
+        b'x = "y"\r\nz = "\xc3\xa4"\r\n',
+        b'\xef\xbb\xbfx = "y"\n',
+        b'# coding: latin-1\r\nx = "\xe4"\r\n',
+        b'"""doc"""\rx = f"{y}" "z"',
+        b"x = '\xc3\xa4'\n" * 100000 + b'y = "z"\n',
+        # only the tree engine can handle this
+        b'x = "y"\nif x:\n  y = "a"\n z = "b"\n',
+    ),
+)
+def test_stream(cli_runner, data):
+    path = Path('code/big.py')
+    path.write_bytes(data)
+    code, encoding = decode_source(data)
+    expected = transform_source(code, engine='tokens').encode(encoding)
+    args = ['--stream-threshold', '1', '--no-cache']
+    result = cli_runner.invoke(main, [*args, '--check', str(path)])
+    assert result.exit_code == 1
+    assert result.stderr == 'code/big.py needs changes\n'
+    assert path.read_bytes() == data
+    result = cli_runner.invoke(main, [*args, str(path)])
+    assert result.exit_code == 1
+    assert result.stderr == 'Updated code/big.py\n'
+    assert path.read_bytes() == expected
+    assert not list(Path('code').glob('*.pyquoted'))
+    result = cli_runner.invoke(main, [*args, str(path)])
+    assert result.exit_code == 0
+
+
+@pytest.mark.parametrize('pipeline', (False, True))
+def test_stream_directory(cli_runner, pipeline):
+    inode = Path('code/a.py').stat().st_ino
+    args = ['--stream-threshold', '1', '--jobs=1', '--verbose', 'code']
+    if pipeline:
+        args.insert(0, '--pipeline')
+    result = cli_runner.invoke(main, args, prog_name='pyquotes')
+    assert result.exit_code == 1
+    assert 'Updated code/nested/b.py' in result.stderr.splitlines()
+    _assert_unchanged('a.py')
+    _assert_changed('nested/b.py')
+    _assert_changed('nested/weird.py')
+    # files which do not need changes are never written
+    assert Path('code/a.py').stat().st_ino == inode
+
+
+@pytest.mark.parametrize(
+    ('size', 'expected'), (('1', 1), ('512k', 512 * 1024), ('2M', 2 * 1024 * 1024))
+)
+def test_stream_threshold(size, expected):
+    config = main.make_context('pyquotes', ['--stream-threshold', size, 'code']).params
+    assert config['stream_threshold'] == expected
+
+
+@pytest.mark.parametrize('size', ('0', 'x', '1KM', '-1', '1.5M'))
+def test_stream_threshold_invalid(cli_runner, size):
+    result = cli_runner.invoke(main, ['--stream-threshold', size, 'code'])
+    assert result.exit_code == 2
+    assert f'invalid size: {size}' in result.stderr
+
+
+def test_engine(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--engine', 'tokens', 'code'], prog_name='pyquotes'
+    )
+    _assert_unchanged('a.py')
+    _assert_changed('nested/b.py')
+    _assert_changed('nested/weird.py')
+    assert result.exit_code == 1
+
+
+def test_quick_reject(cli_runner, monkeypatch):
+    def _fail(*a, **kw):
+        raise Exception('kaboom')
+
+    monkeypatch.setattr('pyquotes.cli.iter_edits', _fail)
+    monkeypatch.setattr('pyquotes.cli.MMAP_THRESHOLD', 0)
+    Path('code/empty.py').touch()
+    result = cli_runner.invoke(
+        main, ['--verbose', 'code/a.py', 'code/empty.py'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 0
+    assert result.stderr.strip().splitlines() == [
+        'code/a.py is up to date',
+        'code/empty.py is up to date',
+        '2 file(s) did not need to be parsed',
+    ]
+
+
+def test_line_ranges(cli_runner):
+    Path('code/lines.py').write_text('a = "a"\nb = "b"\nc = "c"\nd = "d"\n')
+    result = cli_runner.invoke(
+        main, ['--line-ranges', '1,3-4', 'code/lines.py'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    assert Path('code/lines.py').read_text() == "a = 'a'\nb = \"b\"\nc = 'c'\nd = 'd'\n"
+
+
+@pytest.mark.parametrize('value', ('foo', '0', '5-3', '1-x'))
+def test_line_ranges_invalid(cli_runner, value):
+    result = cli_runner.invoke(
+        main, ['--line-ranges', value, 'code/a.py'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 2
+    assert 'invalid line range' in result.stderr
+
+
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+def test_timings(cli_runner, engine):
+    result = cli_runner.invoke(
+        main,
+        ['--timings-json', 'timings.json', '--jobs=1', '--engine', engine, 'code'],
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    lines = result.stderr.splitlines()
+    start = lines.index('Timings for 3 file(s):') + 2
+    end = lines.index('Slowest files:')
+    stages = {line.split()[0] for line in lines[start:end]}
+    expected = {'walk', 'exclude', 'read', 'decode', 'scan', 'normalize', 'write'}
+    assert stages >= expected
+    assert ('parse' in stages) == (engine == 'tree')
+    report = json.loads(Path('timings.json').read_text())
+    assert set(report['files']) == {
+        'code/a.py',
+        'code/nested/b.py',
+        'code/nested/weird.py',
+    }
+    assert set(report['stages']) == stages
+
+
+def test_profile(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--profile', 'out.pstats', '--jobs=1', 'code'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    stats = pstats.Stats('out.pstats')
+    assert any(func[2] == '_process_file' for func in stats.stats)
+
+
+def test_stdin(cli_runner):
+    result = cli_runner.invoke(
+        main, ['-'], input='x = "\x1b[1m"\n', prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    assert result.output == "x = '\x1b[1m'\n"
+    assert result.stderr == ''
+
+
+def test_stdin_uptodate(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--verbose', '-'], input="x = 'y'\n", prog_name='pyquotes'
+    )
+    assert result.exit_code == 0
+    assert result.output == "x = 'y'\n"
+    assert result.stderr.strip() == '- is up to date'
+
+
+def test_stdin_check(cli_runner):
+    result = cli_runner.invoke(
+        main,
+        ['--check', '--stdin-filename', 'code/foo.py', '-'],
+        input='x = "y"\n',
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    assert result.output == ''
+    assert result.stderr.strip() == 'code/foo.py needs changes'
+
+
+def test_stdin_diff(cli_runner, monkeypatch):
+    monkeypatch.setattr('pyquotes.cli._getmtime', lambda x: '<time is meaningless>')
+    result = cli_runner.invoke(main, ['--diff', '-'], input='x = "y"\n')
+    assert result.exit_code == 1
+    assert result.output.strip().splitlines() == [
+        '--- -:before\t<time is meaningless>',
+        '+++ -:after\t<time is meaningless>',
+        '@@ -1 +1 @@',
+        '-x = "y"',
+        "+x = 'y'",
+    ]
+
+
+def test_stdin_patch(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--patch', '--stdin-filename', 'foo.py', '-'], input='x = "y"\n'
+    )
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        'diff --git a/foo.py b/foo.py',
+        '--- a/foo.py',
+        '+++ b/foo.py',
+        '@@ -1 +1 @@',
+        '-x = "y"',
+        "+x = 'y'",
+    ]
+
+
+def test_stdin_excluded(cli_runner):
+    result = cli_runner.invoke(
+        main,
+        ['--verbose', '--stdin-filename', 'code/build/foo.py', '-'],
+        input='x = "y"\n',
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 0
+    assert result.output == 'x = "y"\n'
+    assert result.stderr.strip() == 'code/build/foo.py is excluded'
+
+
+def test_stdin_excluded_relative(cli_runner):
+    # without a config file the excludes are relative to the current directory
+    result = cli_runner.invoke(
+        main,
+        ['--verbose', '-X', 'sub/gen', '--stdin-filename', 'sub/gen/x.py', '-'],
+        input='x = "y"\n',
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 0
+    assert result.output == 'x = "y"\n'
+    assert result.stderr.strip() == 'sub/gen/x.py is excluded'
+
+
+@pytest.mark.parametrize(
+    ('name', 'excluded'), (('foo.py', False), ('build/foo.py', True))
+)
+def test_stdin_excluded_absolute(cli_runner, name, excluded):
+    # only the directories inside the project root may be excluded
+    root = Path('build/proj').absolute()
+    (root / '.git').mkdir(parents=True)
+    filename = str(root / name)
+    result = cli_runner.invoke(
+        main,
+        ['--verbose', '--stdin-filename', filename, '-'],
+        input='x = "y"\n',
+        prog_name='pyquotes',
+    )
+    if excluded:
+        assert result.exit_code == 0
+        assert result.output == 'x = "y"\n'
+        assert result.stderr.strip() == f'{filename} is excluded'
+    else:
+        assert result.exit_code == 1
+        assert result.output == "x = 'y'\n"
+
+
+def test_stdin_config(cli_runner):
+    Path('code/setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    result = cli_runner.invoke(
+        main,
+        ['--stdin-filename', 'code/foo.py', '-'],
+        input="x = 'y'\n",
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    assert result.output == 'x = "y"\n'
+
+
+@pytest.mark.parametrize(
+    ('args', 'error'),
+    (
+        (['-', 'code/a.py'], '"-" cannot be combined with other files'),
+        (['--stdin-filename', 'foo.py', 'code/a.py'], 'stdin-filename requires "-"'),
+        (['--diff', '--patch', '-'], 'diff and patch are mutually exclusive'),
+    ),
+)
+def test_stdin_invalid(cli_runner, args, error):
+    result = cli_runner.invoke(main, args, prog_name='pyquotes')
+    assert result.exit_code == 2
+    assert error in result.stderr
+
+
+def _get_imported_modules(*args):
+    # run the CLI in a fresh interpreter and collect the modules it imported
+    # according to `-X importtime`; this is a much more reliable way to notice
+    # startup time regressions than measuring the (noisy) time it takes
+    code = 'from pyquotes.cli import main; main(prog_name="pyquotes")'
+    env = {**os.environ, 'PYTHONPATH': str(Path(pyquotes.__file__).parent.parent)}
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code, *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        universal_newlines=True,
+    )
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('| package'):
+            modules.add(line.rsplit('|', 1)[1].strip())
+    return modules
+
+
+needs_importtime = pytest.mark.skipif(
+    sys.version_info < (3, 7), reason='-X importtime requires Python 3.7'
+)
+
+# modules that take a significant time to import and are not needed in most cases
+HEAVY_MODULES = {
+    'asyncio',
+    'parso',
+    'difflib',
+    'toml',
+    'concurrent.futures.process',
+    'pyquotes.git',
+}
+
+
+@needs_importtime
+@pytest.mark.parametrize(
+    'args',
+    (
+        ('--version',),
+        ('--help',),
+        ('--jobs=1', 'code/a.py'),
+        ('--jobs=1', '--check', 'code'),
+        ('--jobs=1', '--diff', 'code/a.py'),
+        ('--jobs=1', '--patch', 'code/a.py'),
+    ),
+)
+def test_startup_imports(cli_runner, args):
+    cli_runner.invoke(main, ['--jobs=1', 'code'])  # populate the cache
+    assert not (_get_imported_modules(*args) & HEAVY_MODULES)
+
+
+@needs_importtime
+def test_startup_imports_parso(cli_runner):
+    # make sure the check above actually works
+    modules = _get_imported_modules('--jobs=1', '--no-cache', '--check', 'code')
+    assert 'parso' in modules
@@ -0,0 +1,135 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from pyquotes.daemon import _ConfigCache, make_server
+
+
+@pytest.fixture(scope='module')
+def server_url():
+    server = make_server(port=0)
+    server.quiet = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://localhost:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def _request(url, data=None, headers=None):
+    request = urllib.request.Request(url, data=data, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.read().decode()
+
+
+def test_health(server_url):
+    assert _request(f'{server_url}/health') == (200, 'ok\n')
+
+
+def test_not_found(server_url):
+    assert _request(f'{server_url}/foo')[0] == 404
+    assert _request(f'{server_url}/foo', b'x = 1\n')[0] == 404
+
+
+@pytest.mark.parametrize(
+    ('source', 'headers', 'expected'),
+    (
+        (b'x = "foo"\n', {}, (200, "x = 'foo'\n")),
+        (b"x = 'foo'\n", {}, (204, '')),
+        (b"x = 'foo'\n", {'X-Double-Quotes': 'yes'}, (200, 'x = "foo"\n')),
+        (b'x = "foo"\n', {'X-Engine': 'tokens'}, (200, "x = 'foo'\n")),
+        (b'x = "foo"\n', {'X-Engine': 'foo'}, (400, 'invalid X-Engine header\n')),
+        (
+            b'x = "foo"\n',
+            {'X-Double-Quotes': 'maybe'},
+            (400, 'invalid X-Double-Quotes header\n'),
+        ),
+    ),
+)
+def test_transform(server_url, source, headers, expected):
+    assert _request(server_url, source, headers) == expected
+
+
+def test_invalid_encoding(server_url):
+    status, body = _request(server_url, b'x = "\xff"\n')
+    assert status == 400
+    assert body.startswith('could not decode request body')
+
+
+def test_filename(server_url, tmp_path):
+    (tmp_path / '.git').mkdir()
+    (tmp_path / 'setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    headers = {'X-Filename': str(tmp_path / 'a.py')}
+    assert _request(server_url, b"x = 'foo'\n", headers) == (200, 'x = "foo"\n')
+    headers['X-Double-Quotes'] = 'no'
+    assert _request(server_url, b'x = "foo"\n', headers) == (200, "x = 'foo'\n")
+    headers = {'X-Filename': str(tmp_path / 'build' / 'a.py')}
+    assert _request(server_url, b"x = 'foo'\n", headers) == (204, '')
+
+
+def test_filename_excluded_parent(server_url, tmp_path):
+    # only the directories inside the project may be excluded
+    root = tmp_path / 'build' / 'proj'
+    (root / '.git').mkdir(parents=True)
+    headers = {'X-Filename': str(root / 'a.py')}
+    assert _request(server_url, b'x = "foo"\n', headers) == (200, "x = 'foo'\n")
+    headers = {'X-Filename': str(root / 'build' / 'a.py')}
+    assert _request(server_url, b'x = "foo"\n', headers) == (204, '')
+
+
+def test_filename_config_cached(server_url, tmp_path, monkeypatch):
+    from pyquotes import settings
+
+    parsed = []
+    get_config_data = settings._get_config_data
+    monkeypatch.setattr(
+        settings,
+        '_get_config_data',
+        lambda path, *a: parsed.append(path) or get_config_data(path, *a),
+    )
+    (tmp_path / '.git').mkdir()
+    (tmp_path / 'setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    for name in ('a.py', 'b.py', 'a.py'):
+        headers = {'X-Filename': str(tmp_path / name)}
+        assert _request(server_url, b"x = 'foo'\n", headers) == (200, 'x = "foo"\n')
+    assert parsed == [tmp_path / 'setup.cfg']
+
+
+def test_filename_config_changed(server_url, tmp_path):
+    (tmp_path / '.git').mkdir()
+    config_file = tmp_path / 'setup.cfg'
+    config_file.write_text('[pyquotes]\ndouble-quotes = true\n')
+    headers = {'X-Filename': str(tmp_path / 'foo.py')}
+    assert _request(server_url, b"x = 'foo'\n", headers) == (200, 'x = "foo"\n')
+    config_file.write_text('[pyquotes]\ndouble-quotes = false\n')
+    assert _request(server_url, b"x = 'foo'\n", headers) == (204, '')
+    config_file.unlink()
+    assert _request(server_url, b'x = "foo"\n', headers) == (200, "x = 'foo'\n")
+
+
+def test_config_cache_size(tmp_path):
+    cache = _ConfigCache(max_size=2)
+    for name in ('a', 'b', 'c'):
+        (tmp_path / name).mkdir()
+        cache.get({}, tmp_path / name / 'foo.py')
+    assert len(cache._configs) == 1
+
+
+def test_concurrent(server_url):
+    results = []
+
+    def _worker(i):
+        source = f'x{i} = "{i}"\n'.encode()
+        results.append((i, _request(server_url, source)))
+
+    threads = [threading.Thread(target=_worker, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [(i, (200, f"x{i} = '{i}'\n")) for i in range(20)]
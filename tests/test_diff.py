@@ -0,0 +1,139 @@
+import difflib
+import subprocess
+
+import pytest
+
+from pyquotes.diff import format_patch, unified_diff
+from pyquotes.transform import apply_edits, iter_edits
+
+
+def _difflib_diff(old, new):
+    return list(
+        difflib.unified_diff(
+            old.splitlines(), new.splitlines(), 'a', 'b', 'x', 'y', lineterm=''
+        )
+    )
+
+
+def _diff(old, double_quotes=False):
+    edits = list(iter_edits(old, double_quotes, engine='tokens'))
+    new = apply_edits(old, edits)
+    return list(unified_diff(old, new, edits, 'a', 'b', 'x', 'y')), new
+
+
+@pytest.mark.parametrize(
+    'old',
+    (
+        'x = "a"\n',
+        'x = "a"',
+        'x = "a"\ny = "b"\n',
+        '\n' * 10 + 'x = "a"\n' + '\n' * 10,
+        ''.join(f'x{i} = "a"\n' if i % 7 == 0 else f'y{i} = 1\n' for i in range(50)),
+        'x = """\n"foo"\n"""\ny = 1\nz = "a"\n',
+        'x = "a"\r\ny = 1\rz = "b"\n',
+        'x = "a"\ny = 1\nx = "a"\nx = \'a\'\n',
+        # lines appearing more than 1% of the time are ignored by difflib
+        # in files of 200+ lines
+        '\n'.join(f'x{i} = "a"' if i % 2 == 0 else '' for i in range(300)) + '\n',
+        '\n'.join('x = "a"' if i % 5 == 0 else 'pass' for i in range(300)) + '\n',
+        '\n' * 3 + '\n'.join(f'x{i} = "a"\n' for i in range(200)),
+        ''.join(f'y{i} = 1\nx = "a"\n\n' for i in range(100)),
+    ),
+)
+@pytest.mark.parametrize('double_quotes', (False, True))
+def test_unified_diff_same_as_difflib(old, double_quotes):
+    if double_quotes:
+        old = old.replace('"', "'")
+    diff, new = _diff(old, double_quotes)
+    assert new != old
+    assert diff == _difflib_diff(old, new)
+
+
+def test_unified_diff_no_changes():
+    assert list(unified_diff('x = 1\n', 'x = 1\n', [], 'a', 'b')) == []
+
+
+def test_unified_diff():
+    diff, __ = _diff('x = "a"\n' + 'pass\n' * 10 + 'y = "b"\n')
+    assert diff == [
+        '--- a\tx',
+        '+++ b\ty',
+        '@@ -1,4 +1,4 @@',
+        '-x = "a"',
+        "+x = 'a'",
+        ' pass',
+        ' pass',
+        ' pass',
+        '@@ -9,4 +9,4 @@',
+        ' pass',
+        ' pass',
+        ' pass',
+        '-y = "b"',
+        "+y = 'b'",
+    ]
+
+
+@pytest.mark.parametrize(
+    ('old', 'expected'),
+    (
+        (
+            'x = "a"\ny = 1\n',
+            [
+                '@@ -1,2 +1,2 @@',
+                '-x = "a"',
+                "+x = 'a'",
+                ' y = 1',
+            ],
+        ),
+        (
+            'y = 1\r\nx = "a"',
+            [
+                '@@ -1,2 +1,2 @@',
+                ' y = 1\r',
+                '-x = "a"',
+                '\\ No newline at end of file',
+                "+x = 'a'",
+                '\\ No newline at end of file',
+            ],
+        ),
+        (
+            'y = 1\rx = "a"\n',
+            [
+                '@@ -1 +1 @@',
+                '-y = 1\rx = "a"',
+                "+y = 1\rx = 'a'",
+            ],
+        ),
+    ),
+)
+def test_format_patch(old, expected):
+    edits = list(iter_edits(old, engine='tokens'))
+    new = apply_edits(old, edits)
+    patch = format_patch('foo/bar.py', old, new, edits)
+    assert patch.endswith('\n')
+    assert patch.split('\n')[:-1] == [
+        'diff --git a/foo/bar.py b/foo/bar.py',
+        '--- a/foo/bar.py',
+        '+++ b/foo/bar.py',
+        *expected,
+    ]
+
+
+def test_format_patch_git_apply(tmp_path):
+    subprocess.run(['git', 'init', '-q'], cwd=tmp_path, check=True)
+    files = {
+        'a.py': 'x = "a"\n' + 'pass\n' * 10 + 'y = "b"\r\nz = "c"',
+        'sub/b.py': 'x = 1\n\n' * 150 + 'x = "a"\n',
+    }
+    patch = ''
+    for name, old in files.items():
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(old.encode())
+        edits = list(iter_edits(old, engine='tokens'))
+        patch += format_patch(name, old, apply_edits(old, edits), edits)
+    subprocess.run(
+        ['git', 'apply', '-'], input=patch.encode(), cwd=tmp_path, check=True
+    )
+    for name, old in files.items():
+        new = (tmp_path / name).read_bytes().decode()
+        assert new == apply_edits(old, iter_edits(old, engine='tokens'))
@@ -0,0 +1,38 @@
+import codecs
+
+import pytest
+
+from pyquotes.encoding import decode_source
+
+
+@pytest.mark.parametrize(
+    ('data', 'expected'),
+    (
+        (b'x = "\xc3\xa4"\n', ('x = "\xe4"\n', 'utf-8')),
+        (b'x = "y"\r\nz = 1\r\n', ('x = "y"\r\nz = 1\r\n', 'utf-8')),
+        (codecs.BOM_UTF8 + b'x = "y"\n', ('x = "y"\n', 'utf-8-sig')),
+        (b'# -*- coding: latin-1 -*-\nx = "\xe4"\n', None),
+        (b'#!/usr/bin/env python\n# coding=cp1252\nx = "\x80"\n', None),
+        (b'\n\n# coding: latin-1\nx = "\xc3\xa4"\n', None),
+        (b'x = "coding"\n', ('x = "coding"\n', 'utf-8')),
+    ),
+)
+def test_decode_source(data, expected):
+    source, encoding = decode_source(data)
+    if expected is not None:
+        assert (source, encoding) == expected
+    # the original data can always be restored
+    assert source.encode(encoding) == data
+
+
+def test_decode_source_cookie():
+    assert decode_source(b'# coding: latin-1\nx = "\xe4"\n')[1] == 'iso-8859-1'
+    # only the first two lines may contain a cookie
+    assert decode_source(b'\n\n# coding: latin-1\nx = "\xc3\xa4"\n')[1] == 'utf-8'
+
+
+def test_decode_source_invalid():
+    with pytest.raises(UnicodeDecodeError):
+        decode_source(b'x = "\xe4"\n')
+    with pytest.raises(SyntaxError):
+        decode_source(b'# coding: foobar\n')
@@ -0,0 +1,118 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from pyquotes.cli import main
+from pyquotes.git import GitError, get_changed_files, get_changed_lines
+
+
+pytestmark = pytest.mark.skipif(not shutil.which('git'), reason='git not installed')
+
+
+def _git(*args):
+    subprocess.run(('git', *args), check=True, stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def cli_runner():
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        _git('init', '-q')
+        _git('symbolic-ref', 'HEAD', 'refs/heads/main')
+        _git('config', 'user.email', 'test@example.com')
+        _git('config', 'user.name', 'Test')
+        Path('pkg/build').mkdir(parents=True)
+        for name in ('a.py', 'pkg/b.py', 'pkg/c.py', 'pkg/build/d.py', 'e.txt'):
+            Path(name).write_text('x = "y"\n')
+        _git('add', '.')
+        _git('commit', '-q', '-m', 'initial')
+        _git('checkout', '-q', '-b', 'feature')
+        Path('pkg/b.py').write_text('x = "z"\n')
+        Path('pkg/build/d.py').write_text('x = "z"\n')
+        Path('pkg/new.py').write_text('x = "new"\n')
+        Path('e.txt').write_text('x = "z"\n')
+        _git('rm', '-q', 'pkg/c.py')
+        yield runner
+
+
+def test_get_changed_files(cli_runner):
+    root = Path.cwd().resolve()
+    assert get_changed_files('main', Path.cwd()) == {
+        root / 'pkg/b.py',
+        root / 'pkg/build/d.py',
+        root / 'pkg/new.py',
+        root / 'e.txt',
+    }
+
+
+def test_get_changed_files_invalid_ref(cli_runner):
+    with pytest.raises(GitError):
+        get_changed_files('nope', Path.cwd())
+
+
+def test_changed_since(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--check', '--changed-since', 'main', '.'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    assert result.stderr.strip().splitlines() == [
+        'pkg/b.py needs changes',
+        'pkg/new.py needs changes',
+    ]
+
+
+def test_changed_since_explicit_files(cli_runner):
+    result = cli_runner.invoke(
+        main,
+        ['--check', '--changed-since', 'main', 'a.py', 'e.txt', 'pkg/build/d.py'],
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    assert result.stderr.strip().splitlines() == [
+        'e.txt needs changes',
+        'pkg/build/d.py needs changes',
+    ]
+
+
+def test_changed_since_invalid_ref(cli_runner):
+    result = cli_runner.invoke(
+        main, ['--changed-since', 'nope', '.'], prog_name='pyquotes'
+    )
+    assert result.exit_code == 1
+    assert result.stderr.startswith('Error: Could not get changed files: ')
+
+
+def test_get_changed_lines(cli_runner):
+    Path('pkg/b.py').write_text('x = "z"\n+++ b/foo\n@@ -1 +1 @@\ny = "a"\n')
+    Path('untracked.py').touch()
+    root = Path.cwd().resolve()
+    assert get_changed_lines('main', Path.cwd()) == {
+        root / 'pkg/b.py': [(1, 4)],
+        root / 'pkg/build/d.py': [(1, 1)],
+        root / 'pkg/new.py': None,
+        root / 'untracked.py': None,
+        root / 'e.txt': [(1, 1)],
+    }
+
+
+def test_changed_lines(cli_runner):
+    Path('pkg/b.py').write_text('a = "a"\nb = "b"\nc = "c"\n')
+    _git('commit', '-q', '-am', 'update')
+    Path('pkg/b.py').write_text('a = "a"\nb = "changed"\nc = "c"\n')
+    result = cli_runner.invoke(
+        main,
+        ['--changed-since', 'HEAD', '--changed-lines', 'pkg/b.py', 'pkg/new.py'],
+        prog_name='pyquotes',
+    )
+    assert result.exit_code == 1
+    assert Path('pkg/b.py').read_text() == 'a = "a"\nb = \'changed\'\nc = "c"\n'
+    assert Path('pkg/new.py').read_text() == "x = 'new'\n"
+
+
+def test_changed_lines_without_changed_since(cli_runner):
+    result = cli_runner.invoke(main, ['--changed-lines', '.'], prog_name='pyquotes')
+    assert result.exit_code == 2
+    assert 'changed-lines requires changed-since' in result.stderr
@@ -0,0 +1,122 @@
+import random
+import re
+from pathlib import Path
+
+import parso
+import pytest
+
+from pyquotes.quotes import D3, S3, STRING_PREFIX_CHARS, normalize_string_quotes
+from pyquotes.transform import _iter_strings
+
+
+class _Leaf:
+    def __init__(self, value):
+        self.value = value
+
+
+def _sub_twice(regex, replacement, original):
+    return regex.sub(replacement, regex.sub(replacement, original))
+
+
+def _regex_normalize_string_quotes(leaf, is_doc, double_quotes=False):
+    # the original regex-based implementation, used as a reference
+    value = leaf.value.lstrip(STRING_PREFIX_CHARS)
+    if double_quotes and value[:3] in (D3, S3):
+        if value[:3] == D3:
+            return
+        orig_quote = S3
+        new_quote = D3
+    elif value[:3] == D3:
+        if is_doc:
+            return
+        orig_quote = D3
+        new_quote = S3
+    elif value[:3] == S3:
+        if not is_doc:
+            return
+        orig_quote = S3
+        new_quote = D3
+    elif value[0] == '"':
+        orig_quote = '"'
+        new_quote = "'"
+    else:
+        orig_quote = "'"
+        new_quote = '"'
+
+    first_quote_pos = leaf.value.find(orig_quote)
+    prefix = leaf.value[:first_quote_pos]
+    unescaped_new_quote = re.compile(rf'(([^\\]|^)(\\\\)*){new_quote}')
+    escaped_new_quote = re.compile(rf'([^\\]|^)\\((?:\\\\)*){new_quote}')
+    escaped_orig_quote = re.compile(rf'([^\\]|^)\\((?:\\\\)*){orig_quote}')
+    body = leaf.value[(first_quote_pos + len(orig_quote)) : -len(orig_quote)]
+
+    if 'r' in prefix.casefold():
+        if unescaped_new_quote.search(body):
+            return
+        new_body = body
+    else:
+        new_body = _sub_twice(escaped_new_quote, rf'\1\2{new_quote}', body)
+        if body != new_body:
+            body = new_body
+            leaf.value = f'{prefix}{orig_quote}{body}{orig_quote}'
+        new_body = _sub_twice(escaped_orig_quote, rf'\1\2{orig_quote}', new_body)
+        new_body = _sub_twice(unescaped_new_quote, rf'\1\\{new_quote}', new_body)
+
+    if 'f' in prefix.casefold():
+        matches = re.findall(
+            r'''
+            (?:[^{]|^)\{
+                ([^{].*?)
+            \}(?:[^}]|$)
+            ''',
+            new_body,
+            re.VERBOSE,
+        )
+        for m in matches:
+            if '\\' in str(m):
+                return
+
+    if new_quote == D3 and new_body[-1:] == '"':
+        new_body = new_body[:-1] + '\\"'
+    elif new_quote == S3 and new_body[-1:] == "'":
+        new_body = new_body[:-1] + "\\'"
+
+    orig_escape_count = body.count('\\')
+    new_escape_count = new_body.count('\\')
+    if new_escape_count > orig_escape_count:
+        return
+
+    string_quote_style = '"' if double_quotes else "'"
+    if new_escape_count == orig_escape_count and orig_quote == string_quote_style:
+        return
+
+    leaf.value = f'{prefix}{new_quote}{new_body}{new_quote}'
+
+
+def _check(value, is_doc, double_quotes):
+    expected = _Leaf(value)
+    _regex_normalize_string_quotes(expected, is_doc, double_quotes)
+    leaf = _Leaf(value)
+    normalize_string_quotes(leaf, is_doc, double_quotes)
+    assert leaf.value == expected.value
+
+
+@pytest.mark.parametrize('datafile', ('single_quotes.py', 'double_quotes.py'))
+@pytest.mark.parametrize('double_quotes', (False, True))
+def test_same_as_regex_fixtures(datafile, double_quotes):
+    source = (Path(__file__).parent / 'data' / datafile).read_text()
+    for is_doc, leaf in _iter_strings(parso.parse(source)):
+        _check(leaf.value, is_doc, double_quotes)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_same_as_regex_fuzzed(seed):
+    rnd = random.Random(seed)
+    prefixes = ('', 'r', 'f', 'b', 'rb', 'fr', 'R', 'F')
+    quotes = ("'", '"', S3, D3)
+    chars = ('\\', '\\', '"', "'", 'a', '{', '}', ' ')
+    for __ in range(2000):
+        quote = rnd.choice(quotes)
+        body = ''.join(rnd.choice(chars) for __ in range(rnd.randint(0, 12)))
+        value = f'{rnd.choice(prefixes)}{quote}{body}{quote}'
+        _check(value, rnd.random() < 0.5, rnd.random() < 0.5)
@@ -1,8 +1,11 @@
 from pathlib import Path
+import sys
 import textwrap
+from fnmatch import fnmatch
 
 import pytest
 
+import pyquotes.settings
 from pyquotes.settings import DEFAULT_EXCLUDE, Config, _find_config
 
 
@@ -24,6 +27,59 @@ def test_is_path_excluded(excludes, path, expected, monkeypatch):
     assert cfg.is_path_excluded(Path(path)) == expected
 
 
+def _is_path_excluded_fnmatch(patterns, project_root, path):
+    # the original implementation, which matched each pattern separately
+    basename = path.name
+    if basename not in ('.', '..') and any(fnmatch(basename, p) for p in patterns):
+        return True
+    absolute_path = path.absolute()
+    try:
+        relative_path = absolute_path.relative_to(project_root)
+    except ValueError:
+        pass
+    else:
+        if any(fnmatch(relative_path, p) for p in patterns):
+            return True
+    return any(fnmatch(absolute_path, p) for p in patterns)
+
+
+@pytest.mark.parametrize(
+    'excludes',
+    (
+        DEFAULT_EXCLUDE,
+        frozenset(),
+        frozenset({'*'}),
+        frozenset({'tests/data', 'a*b', '/test/x/*', '.*', '[!a]*.py', 'src/*/gen'}),
+    ),
+)
+def test_is_path_excluded_same_as_fnmatch(excludes, monkeypatch):
+    monkeypatch.setattr('pyquotes.settings._find_config', lambda p: ('/test', {}))
+    cfg = Config({'exclude': excludes})
+    paths = (
+        '.',
+        '..',
+        '/',
+        '/test',
+        '/test/',
+        '/testing/foo',
+        '/test/tests/data',
+        '/test/tests/data/foo.py',
+        '/other/tests/data',
+        '/test/a/x/b',
+        '/test/x/y.py',
+        '/test/src/pkg/gen',
+        '/test/.hidden/a.py',
+        '/test/build',
+        '/test/foo.egg-info/x.py',
+        'relative/b.py',
+        'venv',
+        'node_modules/foo/a.py',
+    )
+    for path in map(Path, paths):
+        expected = _is_path_excluded_fnmatch(excludes, '/test', path)
+        assert cfg.is_path_excluded(path) == expected, path
+
+
 def test_merge_excludes(monkeypatch):
     monkeypatch.setattr('pyquotes.settings._find_config', lambda p: ('/test', {}))
     cfg = Config({'extend_exclude': ('foo',)})
@@ -141,7 +197,8 @@ def test_find_config_invalid_key(monkeypatch, tmpdir):
 
 def test_find_config_no_toml(monkeypatch, tmpdir):
     monkeypatch.setattr('pyquotes.settings.MAX_CONFIG_SEARCH_DEPTH', 1)
-    monkeypatch.setattr('pyquotes.settings.toml', None)
+    # toml is imported when needed, so make that import fail
+    monkeypatch.setitem(sys.modules, 'toml', None)
     tmpdir = Path(tmpdir)
     (tmpdir / 'pyproject.toml').write_text('[tool.pyquotes]\nfoo = bar')
     with pytest.warns(
@@ -149,3 +206,41 @@ def test_find_config_no_toml(monkeypatch, tmpdir):
         match=r'Could not load .*/pyproject\.toml: To parse toml files, you need to `pip install toml`',
     ):
         assert _find_config(tmpdir) == (tmpdir, {})
+
+
+def test_for_directory(monkeypatch, tmpdir):
+    tmpdir = Path(tmpdir)
+    (tmpdir / '.git').mkdir()
+    (tmpdir / 'a' / 'x').mkdir(parents=True)
+    (tmpdir / 'a' / 'setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    (tmpdir / 'b' / 'x').mkdir(parents=True)
+    (tmpdir / 'b' / 'setup.cfg').write_text('[other]\nfoo = bar\n')
+    loaded = []
+    orig_get_config_data = pyquotes.settings._get_config_data
+
+    def _get_config_data(file_path, sections):
+        loaded.append(file_path)
+        return orig_get_config_data(file_path, sections)
+
+    monkeypatch.setattr('pyquotes.settings._get_config_data', _get_config_data)
+    cfg = Config({'verbose': True}, tmpdir)
+    assert cfg.project_root == tmpdir
+    assert cfg.for_directory(tmpdir) is cfg
+    assert cfg.for_directory(tmpdir / 'b' / 'x') is cfg
+    sub_cfg = cfg.for_directory(tmpdir / 'a' / 'x')
+    assert sub_cfg.project_root == tmpdir / 'a'
+    assert sub_cfg.double_quotes
+    assert sub_cfg.verbose
+    assert cfg.for_directory(tmpdir / 'a') is sub_cfg
+    assert sub_cfg.for_directory(tmpdir / 'b') is cfg
+    # every config file is only parsed once
+    assert sorted(loaded) == [tmpdir / 'a' / 'setup.cfg', tmpdir / 'b' / 'setup.cfg']
+
+
+def test_for_directory_cli_override(tmpdir):
+    tmpdir = Path(tmpdir)
+    (tmpdir / '.git').mkdir()
+    (tmpdir / 'a').mkdir()
+    (tmpdir / 'a' / 'setup.cfg').write_text('[pyquotes]\ndouble-quotes = true\n')
+    cfg = Config({'double_quotes': False}, tmpdir)
+    assert not cfg.for_directory(tmpdir / 'a').double_quotes
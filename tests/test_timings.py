@@ -0,0 +1,84 @@
+import pytest
+
+from pyquotes import timings
+
+
+@pytest.fixture(autouse=True)
+def _stop_timings():
+    yield
+    timings.stop()
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    now = [0]
+    monkeypatch.setattr('pyquotes.timings.time.perf_counter', lambda: now[0])
+
+    def _advance(seconds):
+        now[0] += seconds
+
+    return _advance
+
+
+def test_not_recording(fake_clock):
+    def func():
+        pass
+
+    assert timings.timed('foo', func) is func
+    with timings.measure('foo'):
+        fake_clock(1)
+    assert timings.stop() == {}
+
+
+def test_measure(fake_clock):
+    def func(x):
+        fake_clock(x)
+        return x * 2
+
+    timings.start()
+    with timings.measure('outer'):
+        fake_clock(1)
+        with timings.measure('inner'):
+            fake_clock(2)
+            assert timings.timed('func', func)(3) == 6
+        fake_clock(4)
+    with timings.measure('inner'):
+        fake_clock(5)
+    assert timings.stop() == {'outer': 5, 'inner': 7, 'func': 3}
+
+
+def test_measure_exception(fake_clock):
+    timings.start()
+    with pytest.raises(ValueError):
+        with timings.measure('foo'):
+            fake_clock(1)
+            raise ValueError
+    assert timings.stop() == {'foo': 1}
+
+
+def test_get_report():
+    file_stages = {f'{i}.py': {'read': i, 'parse': 10 * i} for i in range(1, 101)}
+    file_stages['empty.py'] = {'read': 0}
+    report = timings.get_report({'walk': 5}, file_stages)
+    assert report['total'] == 5 + 5050 + 50500
+    assert report['stages'] == {
+        'walk': {'total': 5},
+        'read': {'total': 5050, 'p50': 50, 'p90': 90, 'p99': 99, 'max': 100},
+        'parse': {'total': 50500, 'p50': 500, 'p90': 900, 'p99': 990, 'max': 1000},
+    }
+    assert report['files']['42.py'] == {'total': 462, 'read': 42, 'parse': 420}
+
+
+def test_format_report():
+    file_stages = {'a.py': {'read': 1, 'parse': 2}, 'b.py': {'read': 0.5}}
+    report = timings.get_report({'walk': 0.5}, file_stages)
+    assert timings.format_report(report).splitlines() == [
+        'Timings for 2 file(s):',
+        '  stage          total  share       p50       p90       p99       max',
+        '  walk          0.500s  12.5%',
+        '  read          1.500s  37.5%    0.500s    1.000s    1.000s    1.000s',
+        '  parse         2.000s  50.0%    2.000s    2.000s    2.000s    2.000s',
+        'Slowest files:',
+        '     3.000s a.py (read 1.000s, parse 2.000s)',
+        '     0.500s b.py (read 0.500s)',
+    ]
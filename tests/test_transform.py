@@ -1,8 +1,19 @@
+import itertools
 from pathlib import Path
 
 import pytest
 
-from pyquotes.transform import transform_source
+from pyquotes.quotes import may_change
+from pyquotes.transform import (
+    Document,
+    Edit,
+    _transform_tree,
+    apply_edits,
+    iter_edits,
+    needs_changes,
+    transform_many,
+    transform_source,
+)
 
 
 TEST_DATA_SEP = '# --->'
@@ -23,6 +34,255 @@ def _get_data(datafile):
         ('double_quotes.py', True),
     ),
 )
-def test_transforms(datafile, double_quotes):
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+def test_transforms(datafile, double_quotes, engine):
     orig, expected = _get_data(datafile)
-    assert transform_source(orig, double_quotes=double_quotes) == expected
+    assert transform_source(orig, double_quotes, engine=engine) == expected
+
+
+@pytest.mark.parametrize(
+    'source',
+    (
+        '"doc"\nx = "y"\n',
+        '"doc"',
+        '"doc"; x = "y"\n',
+        '"not" "doc"\n',
+        '"not".doc\n',
+        '\n# comment\n"doc"\n',
+        'x = 1\n"not doc"\n',
+        'def f(x=lambda: "a") -> "b":\n    # c\n    "doc"\n',
+        'def f(): "doc"\n',
+        'class A(B, metaclass=M):\n    "doc"\n    x = "y"\n',
+        'async def f():\n    """doc"""\n',
+        'def f():\n    f"not doc"\n',
+        'x = f"{f\'{a}\'}" + "b"\n',
+    ),
+)
+@pytest.mark.parametrize('double_quotes', (False, True))
+def test_engines_identical(source, double_quotes):
+    expected = transform_source(source, double_quotes, engine='tree')
+    assert transform_source(source, double_quotes, engine='tokens') == expected
+
+
+def test_invalid_engine():
+    with pytest.raises(ValueError, match='unknown engine: foo'):
+        transform_source('', engine='foo')
+    with pytest.raises(ValueError, match='unknown engine: foo'):
+        needs_changes('', engine='foo')
+
+
+@pytest.mark.parametrize(
+    ('source', 'double_quotes', 'expected'),
+    (
+        ("x = 'foo'  # comment", False, False),
+        ("x = 'foo'  # \"comment\"", False, True),
+        ("'''doc'''", False, True),
+        ("x = 'don\\'t'", False, True),
+        ("x = u'foo'", False, True),
+        ("x = rB'foo'", False, True),
+        ("x = Rb'foo'", False, False),
+        ('x = "foo"', True, False),
+        ('x = "foo\\"bar"', True, True),
+        ('x = F"foo"', True, True),
+        ("x = 'foo'", True, True),
+    ),
+)
+def test_may_change(source, double_quotes, expected):
+    assert may_change(source, double_quotes) == expected
+    assert may_change(source.encode(), double_quotes) == expected
+    if not expected:
+        assert _transform_tree(f'{source}\n', double_quotes) == f'{source}\n'
+
+
+def test_may_change_utf16():
+    assert may_change("x = 'foo'".encode('utf-16'))
+
+
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+@pytest.mark.parametrize(
+    ('line_ranges', 'expected'),
+    (
+        (None, '"""doc"""\na = \'a\'\nb = f\'{b}\'\nc = (\n    \'c\'\n)\n'),
+        ((), '"""doc"""\na = "a"\nb = f"{b}"\nc = (\n    "c"\n)\n'),
+        (((1, 2),), '"""doc"""\na = \'a\'\nb = f"{b}"\nc = (\n    "c"\n)\n'),
+        (((3, 4),), '"""doc"""\na = "a"\nb = f\'{b}\'\nc = (\n    "c"\n)\n'),
+        (((2, 2), (5, 6)), '"""doc"""\na = \'a\'\nb = f"{b}"\nc = (\n    \'c\'\n)\n'),
+    ),
+)
+def test_line_ranges(engine, line_ranges, expected):
+    source = '"""doc"""\na = "a"\nb = f"{b}"\nc = (\n    "c"\n)\n'
+    assert transform_source(source, engine=engine, line_ranges=line_ranges) == expected
+
+
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+def test_iter_edits(engine):
+    source = '"""doc"""\r\nä = "ö" + \'x\'\r\nif x:\n    y = (\n        f"{x}"\n    )\n'
+    edits = list(iter_edits(source, engine=engine))
+    assert edits == [
+        Edit(15, 18, '"ö"', "'ö'", 2, 4),
+        Edit(50, 56, 'f"{x}"', "f'{x}'", 5, 8),
+    ]
+    for edit in edits:
+        assert source[edit.start : edit.end] == edit.old
+        line = source.splitlines()[edit.line - 1]
+        assert line[edit.column :].startswith(edit.old)
+    assert apply_edits(source, edits) == transform_source(source, engine=engine)
+
+
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+def test_iter_edits_ordered(engine):
+    source = 'def f(x=lambda: "a") -> "b":\n    \'\'\'doc\'\'\'\n    return "c"\n'
+    edits = list(iter_edits(source, engine=engine))
+    assert [edit.new for edit in edits] == ["'a'", "'b'", '"""doc"""', "'c'"]
+    assert [edit.line for edit in edits] == [1, 1, 2, 3]
+
+
+def test_iter_edits_nothing():
+    assert list(iter_edits("x = 'y'\n")) == []
+    assert list(iter_edits('x = "y"\n', line_ranges=())) == []
+
+
+@pytest.mark.parametrize(
+    ('source', 'line_ranges', 'expected'),
+    (
+        ("x = 'y'\n", None, False),
+        ('x = "y"\n', None, True),
+        ('x = "y"\n', (), False),
+        ('x = \'y\'\nz = "a"\n', ((1, 1),), False),
+        ('x = \'y\'\nz = "a"\n', ((2, 2),), True),
+        ("'''doc'''\n", None, True),
+        # only the tree engine can handle this
+        ('x = "y"\nif x:\n  y = "a"\n z = "b"\n', None, True),
+        # looks like a docstring until the code turns out to be broken
+        ("  '''doc'''\n  x\"\n", None, False),
+    ),
+)
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+def test_needs_changes(engine, source, line_ranges, expected):
+    edits = list(iter_edits(source, engine=engine, line_ranges=line_ranges))
+    assert bool(edits) == expected
+    assert needs_changes(source, engine=engine, line_ranges=line_ranges) == expected
+
+
+def test_needs_changes_stops_early(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        'pyquotes.transform._normalize_string',
+        lambda value, *a: calls.append(value) or value.replace('"', "'"),
+    )
+    assert needs_changes('a = "a"\nb = "b"\n', engine='tokens')
+    assert calls == ['"a"']
+
+
+def test_apply_edits():
+    assert apply_edits('abc', []) == 'abc'
+    edits = [Edit(0, 1, 'a', 'xx', 1, 0), Edit(2, 3, 'c', '', 1, 2)]
+    assert apply_edits('abc', edits) == 'xxb'
+
+
+@pytest.mark.parametrize('double_quotes', (False, True))
+def test_document(double_quotes):
+    versions = [
+        '',
+        'x = "a"\n',
+        '"doc"\nx = "a"\n',
+        '"doc"\nx = "a"\ndef f(y=\'b\'):\n    """doc"""\n    return f"{y}"\n',
+        '"doc"\nx = "a"\ndef f(y=\'b\'):\n    z = 1\n    """doc"""\n    return f"{y}"\n',
+        '"doc"\nx = "a"\nclass A:\n    z = 1\n    """doc"""\n    return f"{y}"\n',
+        '"doc"\nx = "a"\nclass A:\n    """doc"""\n    def f(self) -> "c":\n',
+        'x = "a"\n"not doc"\nclass A:\n    """doc"""\n    def f(self) -> "c":\n',
+        'x = "a"\n"not doc"\nclass A:\n    """doc"""\n    def f(self) -> "c":\n',
+        '"doc"\n',
+    ]
+    document = Document(double_quotes=double_quotes)
+    for source in versions:
+        document.update(source)
+        assert document.source == source
+        assert list(document.iter_edits()) == list(iter_edits(source, double_quotes))
+        assert document.transform() == transform_source(source, double_quotes)
+
+
+@pytest.mark.parametrize(
+    'datafile', ('prefixes.py', 'docstrings.py', 'single_quotes.py')
+)
+def test_document_edit_lines(datafile):
+    source = f'{_get_data(datafile)[0]}\n'
+    document = Document(source)
+    lines = source.splitlines(keepends=True)
+    for i in range(len(lines)):
+        # remove each line in turn, and add it back again
+        for new_lines in (lines[:i] + lines[i + 1 :], lines):
+            new_source = ''.join(new_lines)
+            document.update(new_source)
+            assert document.transform() == transform_source(new_source)
+
+
+def test_document_normalizes_changes(monkeypatch):
+    normalized = []
+
+    def _normalize_string(value, is_doc, double_quotes):
+        normalized.append(value)
+        return f'{value}!'
+
+    monkeypatch.setattr('pyquotes.transform._normalize_string', _normalize_string)
+    source = 'def f():\n    """doc"""\n    x = "a"\n    return "b"\n'
+    document = Document(source)
+    assert document.transform() == source.replace('"\n', '"!\n')
+    assert normalized == ['"""doc"""', '"a"', '"b"']
+    normalized.clear()
+    document.update(source.replace('"a"', '"c"'))
+    assert document.transform() == source.replace('"a"', '"c"').replace('"\n', '"!\n')
+    assert normalized == ['"c"']
+
+
+def test_document_no_diff_parser(monkeypatch):
+    def _diff_parser(*args):
+        raise AttributeError('no diff parser')
+
+    monkeypatch.setattr('parso.python.diff.DiffParser', _diff_parser)
+    document = Document('x = "a"\n')
+    document.update('x = "a"\ny = "b"\n')
+    assert document.transform() == "x = 'a'\ny = 'b'\n"
+
+
+def test_document_line_ranges():
+    source = '"""doc"""\na = "a"\nb = f"{b}"\nc = (\n    "c"\n)\n'
+    document = Document(source)
+    for line_ranges in (None, (), ((1, 2),), ((2, 2), (5, 6))):
+        expected = transform_source(source, line_ranges=line_ranges)
+        assert document.transform(line_ranges) == expected
+
+
+@pytest.mark.parametrize('engine', ('tree', 'tokens'))
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_transform_many(engine, jobs):
+    sources = [(i, f'x = "{i}"\ny = \'{i}\'\n') for i in range(100)]
+    results = transform_many(sources, double_quotes=True, engine=engine, jobs=jobs)
+    assert list(results) == [
+        (key, transform_source(source, True, engine)) for key, source in sources
+    ]
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_transform_many_lazy(jobs):
+    consumed = []
+
+    def _sources():
+        for i in itertools.count():
+            consumed.append(i)
+            yield f'{i}.py', f'x = "{i}"\n'
+
+    results = transform_many(_sources(), jobs=jobs)
+    assert not consumed
+    assert list(itertools.islice(results, 3)) == [
+        ('0.py', "x = '0'\n"),
+        ('1.py', "x = '1'\n"),
+        ('2.py', "x = '2'\n"),
+    ]
+    results.close()
+    assert len(consumed) < 1000
+
+
+def test_transform_many_invalid_engine():
+    with pytest.raises(ValueError, match='unknown engine: foo'):
+        transform_many([], engine='foo')